@@ -8,6 +8,8 @@ import time
 import aiofiles
 from dotenv import load_dotenv
 
+import estimate_cache
+
 load_dotenv()
 FPATH = os.path.dirname(os.path.abspath(__file__))
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.DEBUG)
@@ -38,25 +40,44 @@ async def run_tilesets_cli(cmd):
 
 
 async def get_files_full_path(folder):
+    """Returns the full paths of the geojson files in folder."""
     file_paths = []
     for file in os.listdir(folder):
+        if not file.endswith(".geojson"):
+            continue
         full_path = os.path.join(folder, file)
         file_paths.append(full_path)
     return file_paths
 
 
-async def write_to_file(cmd, file, precision):
-    res = await run_tilesets_cli(cmd=cmd.format(file=file, precision=precision))
-    logging.info(res)
-    if res is None:
-        return None
-    result_js = json.loads(res)
+async def write_to_file(cmd, file, precision, db=None):
+    """
+    Estimates the area of a file and appends it to the estimates file. With a
+    cache db, files whose content was already estimated at this precision are
+    not estimated again.
+    """
+    km2 = None
+    if db is not None:
+        digest = await asyncio.to_thread(estimate_cache.content_hash, db, file)
+        km2 = estimate_cache.get_estimate(db, digest, precision)
+    if km2 is not None:
+        logging.info(f"Cached estimate for {file}: {km2}")
+        result_js = {"km2": km2, "precision": precision}
+    else:
+        res = await run_tilesets_cli(cmd=cmd.format(file=file, precision=precision))
+        logging.info(res)
+        if res is None:
+            return None
+        result_js = json.loads(res)
+        if db is not None:
+            estimate_cache.put_estimate(db, digest, precision, result_js.get("km2"))
     async with aiofiles.open("1m_estimates.txt", "a") as f:
         await f.write(f"{file}\t{result_js.get('km2')}\t{result_js.get('precision')}\n")
     logging.info("Wrote results.")
+    return result_js
 
 
-async def estimate_all_tileset_area(folder, precision):
+async def estimate_all_tileset_area(folder, precision, db=None):
     """
     Wrapper for the tilesets estimate-area command. This will instead estimate
     the area of all files in a folder
@@ -65,10 +86,29 @@ async def estimate_all_tileset_area(folder, precision):
     files = await get_files_full_path(folder)
     tasks = []
     for file in files:
-        tasks.append(write_to_file(cmd=cmd, file=file, precision=precision))
+        tasks.append(write_to_file(cmd=cmd, file=file, precision=precision, db=db))
     await asyncio.gather(*tasks)
 
 
+async def estimate_budget(root, precision, by=estimate_cache.GROUP_COLUMNS):
+    """
+    Estimates every geojson under root, only running the CLI for files whose
+    content changed, and returns the km2 aggregated by region, hazard and level.
+    """
+    db = estimate_cache.connect()
+    estimate_cache.prune(db)
+    folders = [
+        dirpath
+        for dirpath, _, filenames in os.walk(root)
+        if any(name.endswith(".geojson") for name in filenames)
+    ]
+    for folder in folders:
+        await estimate_all_tileset_area(folder=folder, precision=precision, db=db)
+    rows = estimate_cache.aggregate(db, precision, by=by, root=root)
+    db.close()
+    return rows
+
+
 async def determine_source_name(file):
     """
     This function returns the specific source name to be used for
@@ -108,8 +148,17 @@ async def publish_all_tilesets():
     pass
 
 
-def main_estimater(folder, precision="10m"):
-    asyncio.run(estimate_all_tileset_area(folder=folder, precision=precision))
+def main_estimater(folder, precision="10m", cache=True):
+    db = estimate_cache.connect() if cache else None
+    asyncio.run(estimate_all_tileset_area(folder=folder, precision=precision, db=db))
+
+
+def main_budget(root, precision="1m"):
+    rows = asyncio.run(estimate_budget(root=root, precision=precision))
+    for *group, count, km2, missing in rows:
+        group = "/".join(str(value) for value in group)
+        logging.info(f"{group}\t{count} files\t{km2:.2f} km2\t{missing} missing")
+    return rows
 
 
 def main_upload_source(folder):
@@ -0,0 +1,126 @@
+"""Dissolves adjacent same-class hazard polygons before uploading to MapBox"""
+import logging
+import multiprocessing
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import geo_cache
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+CLASS_COLUMN = "Var"  # Hazard class attribute of the NOAH hazard maps
+CELL_SIZE = 0.25  # Grid cell size in degrees (EPSG:4326)
+
+
+def count_vertices(geoms):
+    return int(shapely.get_num_coordinates(np.asarray(geoms)).sum())
+
+
+def assign_grid_cells(gdf, cell_size=CELL_SIZE):
+    """
+    Returns the grid cell key of every feature, based on a point guaranteed to
+    be inside the geometry so each feature belongs to exactly one cell.
+    """
+    points = gdf.geometry.representative_point()
+    col = np.floor(points.x.to_numpy() / cell_size).astype(np.int64)
+    row = np.floor(points.y.to_numpy() / cell_size).astype(np.int64)
+    return pd.Series(list(zip(col, row)), index=gdf.index)
+
+
+def dissolve_cell(cell_gdf, class_column=CLASS_COLUMN):
+    """
+    Merges touching geometries of the same class in a cell. Same-class parts that
+    do not touch are split back into separate features, keeping only polygons so
+    slivers from make_valid do not end up as lines or points. Features without a
+    class are kept unchanged.
+    """
+    unclassified = cell_gdf[class_column].isna()
+    dissolved = cell_gdf[~unclassified].dissolve(
+        by=class_column, aggfunc="first", as_index=False
+    )
+    parts = dissolved.explode(index_parts=False, ignore_index=True)
+    parts = parts[parts.geom_type == "Polygon"]
+    return pd.concat([parts, cell_gdf[unclassified]], ignore_index=True)
+
+
+def dissolve_geodataframe(
+    gdf, class_column=CLASS_COLUMN, cell_size=CELL_SIZE, num_cores=5
+):
+    """
+    Dissolves a GeoDataFrame cell by cell across a process pool.
+
+    Returns:
+        (GeoDataFrame, dict): The dissolved data and a report of removed
+                              features and vertices.
+    """
+    gdf = gdf[~(gdf.geometry.is_empty | gdf.geometry.isna())]
+    gdf = gdf.set_geometry(shapely.make_valid(gdf.geometry.values))
+    cells = [
+        (cell_gdf, class_column)
+        for _, cell_gdf in gdf.groupby(assign_grid_cells(gdf, cell_size), sort=False)
+    ]
+    with multiprocessing.Pool(num_cores) as pool:
+        parts = pool.starmap(dissolve_cell, cells)
+
+    if parts:
+        result = gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), crs=gdf.crs)
+    else:
+        result = gdf.iloc[:0]
+    report = {
+        "cells": len(cells),
+        "features_before": len(gdf),
+        "features_after": len(result),
+        "vertices_before": count_vertices(gdf.geometry),
+        "vertices_after": count_vertices(result.geometry),
+    }
+    report["features_removed"] = report["features_before"] - report["features_after"]
+    report["vertices_removed"] = report["vertices_before"] - report["vertices_after"]
+    return result, report
+
+
+def dissolve_file(
+    geo_file, output_file, class_column=CLASS_COLUMN, cell_size=CELL_SIZE, num_cores=5
+):
+    """
+    Dissolves a geojson file. Write the output under the same filename in another
+    folder so the tileset name from generate_tileset_name stays the same.
+    """
+    logging.info(f"Dissolving {geo_file}.")
+    gdf = geo_cache.read_file(geo_file)
+    if class_column not in gdf.columns:
+        raise ValueError(f"{geo_file} has no {class_column} column to dissolve by")
+    result, report = dissolve_geodataframe(gdf, class_column, cell_size, num_cores)
+    result.to_file(output_file, driver="GeoJSON")
+    logging.info(
+        f"Dissolved {geo_file}: removed {report['features_removed']} features "
+        f"and {report['vertices_removed']} vertices."
+    )
+    return report
+
+
+def dissolve_folder(geo_folder, out_folder, **kwargs):
+    """
+    Dissolves every geojson in a folder into out_folder. Run this before
+    mapbox_api.bulk_create_tileset_source(out_folder).
+    """
+    os.makedirs(out_folder, exist_ok=True)
+    reports = {}
+    for file in sorted(os.listdir(geo_folder)):
+        if file.endswith(".geojson"):
+            reports[file] = dissolve_file(
+                os.path.join(geo_folder, file), os.path.join(out_folder, file), **kwargs
+            )
+    return reports
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    geo_folder = "data/geojson/FH/"
+    out_folder = "data/geojson/FH_dissolved/"
+    dissolve_folder(geo_folder, out_folder)
+    t1 = time.time()
+    logging.info(f"Elapsed time: {t1-t0:.2f}s")
@@ -0,0 +1,128 @@
+"""Content-addressed cache of tilesets estimate-area results"""
+import os
+import sqlite3
+import threading
+import time
+
+from recipe_diff import file_hash
+
+fpath = os.path.dirname(os.path.abspath(__file__))
+CACHE_FILE = os.path.join(fpath, "data", "estimates.sqlite")
+GROUP_COLUMNS = ("region", "hazard", "level")
+cache_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    hash TEXT,
+    region TEXT,
+    hazard TEXT,
+    level TEXT
+);
+CREATE TABLE IF NOT EXISTS estimates (
+    hash TEXT,
+    precision TEXT,
+    km2 REAL,
+    estimated REAL,
+    PRIMARY KEY (hash, precision)
+);
+"""
+
+
+def connect(cache_file=CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    db = sqlite3.connect(cache_file, check_same_thread=False)
+    db.executescript(SCHEMA)
+    return db
+
+
+def path_groups(file):
+    """
+    Returns (region, hazard, level) from the
+    data/geojson/<region>/<hazard>/<level>/<file> folder layout.
+    """
+    parts = os.path.normpath(os.path.abspath(file)).split(os.sep)[-4:-1]
+    return tuple([None] * (3 - len(parts)) + parts)
+
+
+def content_hash(db, file):
+    """
+    Returns the content hash of a file. The file is only hashed again when its
+    mtime or size changed since the last time it was seen.
+    """
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    with cache_lock:
+        row = db.execute(
+            "SELECT hash FROM files WHERE path = ? AND mtime_ns = ? AND size = ?",
+            (path, stat.st_mtime_ns, stat.st_size),
+        ).fetchone()
+    if row:
+        return row[0]
+
+    digest = file_hash(path)
+    with cache_lock, db:
+        db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, digest, *path_groups(path)),
+        )
+    return digest
+
+
+def get_estimate(db, digest, precision):
+    """Returns the cached km2 of a content hash and precision, None if missing."""
+    with cache_lock:
+        row = db.execute(
+            "SELECT km2 FROM estimates WHERE hash = ? AND precision = ?",
+            (digest, precision),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def put_estimate(db, digest, precision, km2):
+    with cache_lock, db:
+        db.execute(
+            "INSERT OR REPLACE INTO estimates VALUES (?, ?, ?, ?)",
+            (digest, precision, km2, time.time()),
+        )
+
+
+def aggregate(db, precision, by=GROUP_COLUMNS, root=None):
+    """
+    Sums the cached km2 of the current version of every known file.
+
+    Args:
+        precision (str): Precision of the estimates, i.e. 1m.
+        by (tuple): Columns to group by, any of region, hazard and level.
+        root (str): Only include files under this folder.
+
+    Returns:
+        list: (*group values, file count, km2, missing) rows. Files without an
+              estimate at this precision add 0 km2 and are counted as missing.
+    """
+    columns = ", ".join(f"files.{column}" for column in by)
+    select = f"{columns}, " if by else ""
+    query = f"""
+        SELECT {select}COUNT(*), SUM(COALESCE(estimates.km2, 0)),
+            SUM(estimates.km2 IS NULL)
+        FROM files LEFT JOIN estimates
+            ON files.hash = estimates.hash AND estimates.precision = ?
+        WHERE substr(files.path, 1, length(?)) = ?
+        {"GROUP BY " + columns if by else ""}
+        ORDER BY {columns or 1}
+    """
+    prefix = os.path.join(os.path.abspath(root), "") if root else ""
+    with cache_lock:
+        return db.execute(query, (precision, prefix, prefix)).fetchall()
+
+
+def prune(db):
+    """Forgets files that no longer exist so they drop out of aggregates."""
+    with cache_lock, db:
+        paths = [row[0] for row in db.execute("SELECT path FROM files")]
+        db.executemany(
+            "DELETE FROM files WHERE path = ?",
+            [(path,) for path in paths if not os.path.isfile(path)],
+        )
@@ -0,0 +1,109 @@
+"""
+GeoParquet cache of the reprojected data of each converted output. A cache is a
+folder of ordered part files, so chunks can be written in parallel. Caches live
+in their own tree mirroring the outputs, i.e. data/cache/data/geojson/FH/
+aklan.parquet/ for data/geojson/FH/aklan.geojson, so folder listings of the
+geojson folders never pick them up.
+"""
+import json
+import os
+import shutil
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+
+fpath = os.path.dirname(os.path.abspath(__file__))
+CACHE_FOLDER = os.path.join(fpath, "data", "cache")
+BATCH_SIZE = 65536  # Rows per record batch when streaming the cache
+
+
+def cache_path(output_file):
+    """Returns the cache folder of a file, by its path relative to the project."""
+    output_file = os.path.abspath(output_file)
+    relative = os.path.relpath(output_file, fpath)
+    if relative.startswith(os.pardir):  # Outside the project, mirror the full path
+        relative = os.path.splitdrive(output_file)[1].lstrip(os.sep)
+    return os.path.join(CACHE_FOLDER, f"{os.path.splitext(relative)[0]}.parquet")
+
+
+def part_path(cache, part=0):
+    return os.path.join(cache, f"part-{part:05d}.parquet")
+
+
+def parts(cache):
+    return [
+        os.path.join(cache, part)
+        for part in sorted(os.listdir(cache))
+        if part.endswith(".parquet")
+    ]
+
+
+def clear_cache(cache):
+    shutil.rmtree(cache, ignore_errors=True)
+
+
+def write_cache(gdf, cache, part=0):
+    """Writes a GeoDataFrame as one part of a cache."""
+    os.makedirs(cache, exist_ok=True)
+    gdf.to_parquet(part_path(cache, part), index=False)
+
+
+def touch(cache):
+    """Marks the cache as written after its source, call once all parts exist."""
+    os.utime(cache)
+
+
+def is_fresh(file):
+    """True if the file has a cache that is not older than the file itself."""
+    cache = cache_path(file)
+    return (
+        os.path.isdir(cache)
+        and bool(parts(cache))
+        and os.path.getmtime(cache) >= os.path.getmtime(file)
+    )
+
+
+def geo_metadata(parquet_file):
+    metadata = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+    column = metadata["primary_column"]
+    # GeoParquet defaults to OGC:CRS84 when the crs is omitted
+    crs = metadata["columns"][column].get("crs", "OGC:CRS84")
+    return column, crs
+
+
+def iter_batches(cache, columns=None, batch_size=BATCH_SIZE):
+    """
+    Streams a cache as GeoDataFrames of batch_size rows in order. Part files are
+    memory-mapped and only the requested columns (plus geometry) are read.
+    """
+    for part in parts(cache):
+        parquet_file = pq.ParquetFile(part, memory_map=True)
+        column, crs = geo_metadata(parquet_file)
+        read_columns = None if columns is None else [*columns, column]
+        for batch in parquet_file.iter_batches(batch_size, columns=read_columns):
+            df = batch.to_pandas()
+            geometry = gpd.GeoSeries.from_wkb(df.pop(column), crs=crs)
+            yield gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
+
+
+def read_cache(cache, columns=None):
+    batches = list(iter_batches(cache, columns))
+    if not batches:
+        return gpd.GeoDataFrame()
+    return gpd.GeoDataFrame(pd.concat(batches, ignore_index=True), crs=batches[0].crs)
+
+
+def read_file(file, columns=None):
+    """Reads a file through its cache when fresh, else parses the file itself."""
+    if is_fresh(file):
+        return read_cache(cache_path(file), columns)
+    gdf = gpd.read_file(file)
+    return gdf if columns is None else gdf[[*columns, gdf.geometry.name]]
+
+
+def iter_features(file, batch_size=BATCH_SIZE):
+    """Yields the GeoJSON features of a file's cache, for upload serialization."""
+    for batch in iter_batches(cache_path(file), batch_size=batch_size):
+        # to_json converts numpy scalars into JSON types
+        yield from json.loads(batch.to_json(na="null", drop_id=True))["features"]
@@ -0,0 +1,10 @@
+"""Shared HTTP session so calls to the MapBox API reuse pooled connections"""
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 20  # Keep in line with the num_workers of the thread pools
+
+session = requests.Session()
+session.mount(
+    "https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+)
@@ -0,0 +1,102 @@
+"""Cached inventory of the tileset sources and tilesets that exist in MapBox"""
+import json
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from http_session import session
+
+load_dotenv()
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+fpath = os.path.dirname(os.path.abspath(__file__))
+INVENTORY_FILE = os.path.join(fpath, "data", "inventory.json")
+INVENTORY_TTL = int(os.getenv("INVENTORY_TTL", 3600))  # seconds
+inventory_lock = threading.Lock()
+_inventory = None
+
+
+def list_all(url):
+    """Returns the ids of all items of a listing endpoint, following pagination."""
+    ids = []
+    params = {"access_token": os.getenv("MAPBOX_ACCESS_TOKEN"), "limit": 500}
+    while url:
+        response = session.request("GET", url=url, params=params)
+        response.raise_for_status()
+        ids.extend(item["id"] for item in response.json())
+        # The next link already carries the start cursor and query parameters
+        url = response.links.get("next", {}).get("url")
+        params = None
+    return ids
+
+
+def fetch_inventory():
+    user = os.getenv("USER")
+    inventory = {
+        "sources": list_all(f"https://api.mapbox.com/tilesets/v1/sources/{user}"),
+        "tilesets": list_all(f"https://api.mapbox.com/tilesets/v1/{user}"),
+        "fetched": time.time(),
+    }
+    logging.info(
+        f"Fetched inventory: {len(inventory['sources'])} sources, "
+        f"{len(inventory['tilesets'])} tilesets."
+    )
+    return inventory
+
+
+def save_inventory(inventory):
+    data = {
+        "sources": sorted(inventory["sources"]),
+        "tilesets": sorted(inventory["tilesets"]),
+        "fetched": inventory["fetched"],
+    }
+    os.makedirs(os.path.dirname(INVENTORY_FILE), exist_ok=True)
+    with open(INVENTORY_FILE, "w") as inventory_file:
+        json.dump(data, inventory_file, indent=4)
+
+
+def get_inventory(refresh=False, ttl=INVENTORY_TTL):
+    """
+    Returns the remote inventory as {"sources": set, "tilesets": set}. It is
+    fetched at most once per TTL and shared between threads and runs through
+    the inventory file.
+    """
+    global _inventory
+    with inventory_lock:
+        if _inventory is None and os.path.isfile(INVENTORY_FILE):
+            with open(INVENTORY_FILE) as inventory_file:
+                _inventory = json.load(inventory_file)
+        if refresh or _inventory is None or time.time() - _inventory["fetched"] > ttl:
+            _inventory = fetch_inventory()
+            save_inventory(_inventory)
+        _inventory["sources"] = set(_inventory["sources"])
+        _inventory["tilesets"] = set(_inventory["tilesets"])
+        return _inventory
+
+
+def mark_created(kind, item_id):
+    """Adds a newly created source or tileset so the cache stays valid."""
+    inventory = get_inventory()
+    with inventory_lock:
+        inventory[kind].add(item_id)
+        save_inventory(inventory)
+
+
+def source_id(source_name):
+    return f"mapbox://tileset-source/{os.getenv('USER')}/{source_name}"
+
+
+def source_exists(source_name):
+    return source_id(source_name) in get_inventory()["sources"]
+
+
+def tileset_exists(tileset_id, refresh_on_miss=False):
+    """
+    Checks the cached inventory. With refresh_on_miss, a miss refetches the
+    inventory once, for tilesets created outside this cache within the TTL.
+    """
+    if tileset_id in get_inventory()["tilesets"]:
+        return True
+    return refresh_on_miss and tileset_id in get_inventory(refresh=True)["tilesets"]
@@ -6,13 +6,31 @@ import os
 import tempfile
 import time
 
-import requests
 from clint.textui.progress import Bar as ProgressBar
 from dotenv import load_dotenv
 from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 
+from http_session import session
+from inventory import mark_created, source_exists, tileset_exists
+from memory_budget import as_budget, budgeted
+from recipe_diff import (
+    CREATE,
+    NOOP,
+    PUBLISH,
+    UPDATE,
+    load_state,
+    plan_action,
+    record_applied,
+    record_source_upload,
+    write_recipe,
+)
 from utils import normalize
 
+try:
+    import geo_cache
+except ImportError:  # geopandas and pyarrow are dev packages
+    geo_cache = None
+
 load_dotenv()
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 RECIPES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes")
@@ -33,10 +51,8 @@ def generate_recipe(tileset_id, geo_file):  # On top for visibility
         },
     }
 
-    with open(
-        recipe_path := os.path.join(RECIPES_FOLDER, f"{filename}.json"), "w"
-    ) as recipe_file:
-        json.dump(recipe, recipe_file, indent=4)
+    recipe_path = os.path.join(RECIPES_FOLDER, f"{filename}.json")
+    write_recipe(recipe, recipe_path)
     return recipe_path
 
 
@@ -50,9 +66,12 @@ def create_callback(encoder):
     return callback
 
 
-def get_files_full_path(folder):
+def get_files_full_path(folder, ext=".geojson"):
+    """Returns the full paths of the files in folder with the extension."""
     file_paths = []
     for file in os.listdir(folder):
+        if not file.endswith(ext):
+            continue
         full_path = os.path.join(folder, file)
         file_paths.append(full_path)
     return file_paths
@@ -64,41 +83,61 @@ def generate_tileset_name(file):
     return "_".join(file.split(".")[:-1]).lower()
 
 
-def concurrent_runner(func, iterable, num_workers=5):
+def concurrent_runner(func, iterable, num_workers=5, memory_budget=None):
     """
-    Executor/runner function to run functions in a ThreadPool.
+    Executor/runner function to run functions in a ThreadPool. With a
+    memory_budget (bytes, i.e. "16G", or a shared MemoryBudget), a file is only
+    processed while the estimated memory of the running tasks fits the budget.
+
+    Returns:
+        dict: Result per item, for the items that did not raise.
     """
+    if memory_budget is not None:
+        func = budgeted(func, as_budget(memory_budget))
+    results = {}
     with concurr.ThreadPoolExecutor(max_workers=num_workers) as executor:
         # Create mapping of executable task for each item in the iterable
         future_to_data = {executor.submit(func, param): param for param in iterable}
         for future in concurr.as_completed(future_to_data):
             file = future_to_data[future]
             try:
-                data = future.result()
+                data = results[file] = future.result()
                 print(data)
             except Exception as e:
                 logging.exception(f"Exception for {os.path.basename(file)}: {e}")
             else:
                 logging.info(f"Successful operation for {os.path.basename(file)}.")
+    return results
+
+
+def iter_upload_features(geo_file):
+    """
+    Yields the features to upload, from the GeoParquet cache written by
+    shp_converter when it is fresh, instead of parsing the geojson text.
+    """
+    if geo_cache is not None and geo_cache.is_fresh(geo_file):
+        return geo_cache.iter_features(geo_file)
+    return normalize(geo_file)
 
 
 def tileset_name_to_source(tileset_name):
     return " ".join(tileset_name.split("_")).title()
 
 
-def create_tileset_source(geo_file, replace=False):
+def create_tileset_source(geo_file, replace=None):
     """
     Creates the tilesource in mapbox. Basically, uploads the geojson into MapBox's
     server for processing.
 
     Args:
         geo_file (str): Full path of the geojson being uploaded
-        replace (bool): Defaults to False. Setting to True will enable the script to
-                        replace the source file.
+        replace (bool): Setting to True will enable the script to replace the source
+                        file. Defaults to None, which replaces the source only if
+                        it already exists in the inventory.
     """
     source_name = generate_tileset_name(os.path.basename(geo_file))
     url = f"https://api.mapbox.com/tilesets/v1/sources/{os.getenv('USER')}/{source_name}?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
-    features = normalize(geo_file)
+    features = iter_upload_features(geo_file)
     with tempfile.TemporaryFile() as file:
         for feature in features:
             file.write(
@@ -110,11 +149,13 @@ def create_tileset_source(geo_file, replace=False):
         callback = create_callback(multipart_encoded_file)
         monitor = MultipartEncoderMonitor(multipart_encoded_file, callback)
 
+        if replace is None:
+            replace = source_exists(source_name)
         method = "POST"
         if replace:
             method = "PUT"
 
-        response = requests.request(
+        response = session.request(
             method,
             url,
             data=monitor,
@@ -127,6 +168,8 @@ def create_tileset_source(geo_file, replace=False):
 
     if response.status_code == 200:
         tileset_id = js_resp.get("id")
+        mark_created("sources", tileset_id)
+        record_source_upload(tileset_id, geo_file)
         recipe_path = generate_recipe(tileset_id, geo_file)
         return recipe_path
 
@@ -140,7 +183,8 @@ def get_layer_name(recipe):
 def create_tileset(recipe, publish=True):
     """
     Function to create an empty tileset using a recipe. Need to publish
-    tileset for it to be usable.
+    tileset for it to be usable. If the tileset already exists in the inventory,
+    its recipe is updated instead.
     Args:
         recipe (str): Full path of the recipe file.
         publish (bool): Specify if you want to publish directly after creating the
@@ -158,17 +202,29 @@ def create_tileset(recipe, publish=True):
     with open(recipe) as json_recipe:
         payload["recipe"] = json.load(json_recipe)
 
-    response = requests.request("POST", url=url, json=payload)
-    logging.info(response.text)
-    if response.status_code != 200:
-        logging.info(f"retrying {tileset_name}")
-        time.sleep(30)
-        response = requests.request("POST", url=url, json=payload)
-        logging.info(f"retried {tileset_name}: {response.status_code}:{response.text}")
+    if tileset_exists(tileset_id := f"{os.getenv('USER')}.{tileset_name}"):
+        logging.info(f"{tileset_id} already exists, updating recipe instead.")
+        if not update_tileset_recipe(recipe):
+            # Publishing now would record a recipe that was never applied
+            logging.info(f"Recipe update of {tileset_id} failed, not publishing.")
+            return False
+    else:
+        response = session.request("POST", url=url, json=payload)
+        logging.info(response.text)
+        if response.status_code != 200:
+            logging.info(f"retrying {tileset_name}")
+            time.sleep(30)
+            response = session.request("POST", url=url, json=payload)
+            logging.info(
+                f"retried {tileset_name}: {response.status_code}:{response.text}"
+            )
+        if response.status_code != 200:
+            return False
+        mark_created("tilesets", tileset_id)
 
     # Run publish
     if publish:
-        publish_tileset(recipe)
+        return publish_tileset(recipe)
 
 
 def update_tileset_recipe(recipe):
@@ -178,49 +234,91 @@ def update_tileset_recipe(recipe):
 
     with open(recipe) as json_recipe:
         payload = json.load(json_recipe)
-    response = requests.request("PATCH", url=url, json=payload)
+    response = session.request("PATCH", url=url, json=payload)
     logging.info(response)
+    # The recipe endpoint answers 201/204 on success
+    return response.ok
 
 
 def publish_tileset(recipe):
     """Function to process and publish created tileset."""
     tileset_name = get_layer_name(recipe) + "_tls"
+    if not tileset_exists(f"{os.getenv('USER')}.{tileset_name}", refresh_on_miss=True):
+        logging.info(f"{tileset_name} does not exist, create it before publishing.")
+        return False
     url = f"https://api.mapbox.com/tilesets/v1/{os.getenv('USER')}.{tileset_name}/publish?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
-    response = requests.request("POST", url=url)
+    response = session.request("POST", url=url)
     logging.info(f"{response.status_code}:{response.text}")
     if response.status_code != 200:
         logging.info(f"retrying {tileset_name}")
         time.sleep(30)
-        response = requests.request("POST", url=url)
+        response = session.request("POST", url=url)
         logging.info(f"retried {tileset_name}: {response.status_code}:{response.text}")
 
+    if response.status_code == 200:
+        tileset_id = f"{os.getenv('USER')}.{tileset_name}"
+        with open(recipe) as json_recipe:
+            record_applied(tileset_id, json.load(json_recipe))
+        return True
+    return False
+
 
-def bulk_create_tileset_source(folder):
+def sync_tileset(recipe):
+    """
+    Creates, updates or publishes the tileset of a recipe only if the recipe or
+    its sources changed since the last publish. Returns the action taken.
+    """
+    tileset_id = f"{os.getenv('USER')}.{get_layer_name(recipe)}_tls"
+    with open(recipe) as json_recipe:
+        action = plan_action(tileset_id, json.load(json_recipe), load_state())
+    logging.info(f"{tileset_id}: {action}")
+    if action == CREATE:
+        create_tileset(recipe)
+    elif action == UPDATE:
+        if update_tileset_recipe(recipe):
+            publish_tileset(recipe)
+    elif action == PUBLISH:
+        publish_tileset(recipe)
+    return action
+
+
+def bulk_create_tileset_source(folder, num_workers=5, memory_budget=None):
     """
     Args:
         folder (str): The folder containing geojson files. It will not
                       include non-geojson files and sub-dirs.
+        memory_budget (int|str): Optional memory budget, i.e. "16G", to run
+                                 more workers without running out of memory.
     """
     files = get_files_full_path(folder)
-    concurrent_runner(create_tileset_source, files)
+    concurrent_runner(create_tileset_source, files, num_workers, memory_budget)
 
 
 def bulk_create_tilesets_from_recipes(recipe_folder):
     """
     Bulk create tilesets from existing geojson and publishes the created tilesets.
     """
-    recipes = get_files_full_path(recipe_folder)
+    recipes = get_files_full_path(recipe_folder, ".json")
     concurrent_runner(create_tileset, recipes)
 
 
+def bulk_sync_tilesets_from_recipes(recipe_folder):
+    """Runs only the create/update/publish jobs needed for the recipes in a folder."""
+    recipes = get_files_full_path(recipe_folder, ".json")
+    actions = {recipe: sync_tileset(recipe) for recipe in recipes}
+    skipped = sum(action == NOOP for action in actions.values())
+    logging.info(f"Skipped {skipped} of {len(actions)} unchanged tilesets.")
+    return actions
+
+
 def bulk_publish_tilesets_from_recipes(recipe_folder):
-    recipes = get_files_full_path(recipe_folder)
+    recipes = get_files_full_path(recipe_folder, ".json")
     for recipe in recipes:
         publish_tileset(recipe)
         time.sleep(30)
 
 
-def single_upload_pipeline(geo_file, replace=True):
+def single_upload_pipeline(geo_file, replace=None):
     # Upload source file
     create_tileset_source(geo_file, replace=replace)
 
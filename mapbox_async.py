@@ -0,0 +1,269 @@
+"""Asyncio client for the MapBox Tilesets API with a shared connection pool"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+from inventory import mark_created, source_exists, tileset_exists
+from mapbox_api import (
+    generate_recipe,
+    generate_tileset_name,
+    get_files_full_path,
+    get_layer_name,
+    iter_upload_features,
+    tileset_name_to_source,
+)
+from recipe_diff import record_applied, record_source_upload
+
+load_dotenv()
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+API_URL = "https://api.mapbox.com/tilesets/v1"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncMapboxClient:
+    """
+    Async counterpart of the functions in mapbox_api. All requests share one
+    aiohttp session so thousands of small calls reuse a bounded pool of
+    keep-alive connections instead of opening one per request.
+
+    Usage:
+        async with AsyncMapboxClient() as client:
+            await client.publish_tileset(recipe)
+    """
+
+    def __init__(self, max_connections=100, retries=3, retry_delay=1):
+        """
+        Args:
+            max_connections (int): Size of the connection pool, which is also the
+                                   maximum number of requests in flight.
+            retries (int): Number of retries for rate limited or 5xx responses.
+            retry_delay (int): Base delay in seconds, doubled after every retry.
+        """
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.user = os.getenv("USER")
+        self.token = os.getenv("MAPBOX_ACCESS_TOKEN")
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=None)
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def request(self, method, path, file=None, **kwargs):
+        """
+        Sends a request to the tilesets API, returns (status, body). The body is
+        the parsed json, or the text for non-json error pages. A file is sent as
+        multipart form data, rebuilt from the start of the file on every attempt.
+        """
+        url = f"{API_URL}/{path}"
+        params = {"access_token": self.token, **kwargs.pop("params", {})}
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            if file is not None:
+                # aiohttp closes the payload file after sending, so send a
+                # duplicate handle and keep the tempfile for the retries
+                upload = os.fdopen(os.dup(file.fileno()), "rb")
+                upload.seek(0)
+                kwargs["data"] = aiohttp.FormData()
+                kwargs["data"].add_field("file", upload, filename="file")
+            async with self.session.request(
+                method, url, params=params, **kwargs
+            ) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = await response.text()
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    return response.status, body
+            logging.info(f"retrying {method} {path}: {response.status}:{body}")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def create_tileset_source(self, geo_file, replace=None):
+        """
+        Uploads the geojson as a tileset source. Returns the generated recipe path
+        like mapbox_api.create_tileset_source. Defaults to replacing the source
+        only if it already exists in the inventory.
+        """
+        source_name = generate_tileset_name(os.path.basename(geo_file))
+        if replace is None:
+            replace = await asyncio.to_thread(source_exists, source_name)
+        method = "PUT" if replace else "POST"
+        # Normalizing is blocking file IO, keep it off the event loop
+        with await asyncio.to_thread(write_ldgeojson, geo_file) as file:
+            status, js_resp = await self.request(
+                method, f"sources/{self.user}/{source_name}", file=file
+            )
+        logging.info(js_resp)
+        if status == 200:
+            await asyncio.to_thread(mark_created, "sources", js_resp.get("id"))
+            record_source_upload(js_resp.get("id"), geo_file)
+            return generate_recipe(js_resp.get("id"), geo_file)
+
+    async def create_tileset(self, recipe, publish=True):
+        """
+        Creates an empty tileset from a recipe and optionally publishes it. If the
+        tileset already exists in the inventory, its recipe is updated instead.
+        """
+        layer_name = get_layer_name(recipe)
+        tileset_name = layer_name + "_tls"
+        mapbox_name = tileset_name_to_source(layer_name)
+        payload = {
+            "name": mapbox_name,
+            "description": f"Tiles for {mapbox_name}.",
+            "private": False,
+        }
+        with open(recipe) as json_recipe:
+            payload["recipe"] = json.load(json_recipe)
+
+        tileset_id = f"{self.user}.{tileset_name}"
+        js_resp = None
+        if await asyncio.to_thread(tileset_exists, tileset_id):
+            logging.info(f"{tileset_id} already exists, updating recipe instead.")
+            if not 200 <= await self.update_tileset_recipe(recipe) < 300:
+                return None
+        else:
+            status, js_resp = await self.request("POST", tileset_id, json=payload)
+            logging.info(f"{status}:{js_resp}")
+            if status != 200:
+                return js_resp
+            await asyncio.to_thread(mark_created, "tilesets", tileset_id)
+        if publish:
+            return await self.publish_tileset(recipe)
+        return js_resp
+
+    async def update_tileset_recipe(self, recipe):
+        """Updates the recipe of a tileset. Call publish after updating recipe."""
+        tileset_name = get_layer_name(recipe) + "_tls"
+        with open(recipe) as json_recipe:
+            payload = json.load(json_recipe)
+        status, js_resp = await self.request(
+            "PATCH", f"{self.user}.{tileset_name}/recipe", json=payload
+        )
+        logging.info(f"{status}:{js_resp}")
+        return status
+
+    async def publish_tileset(self, recipe):
+        """Publishes the tileset of a recipe. Returns the publish job id."""
+        tileset_name = get_layer_name(recipe) + "_tls"
+        tileset_id = f"{self.user}.{tileset_name}"
+        if not await asyncio.to_thread(tileset_exists, tileset_id, True):
+            logging.info(f"{tileset_name} does not exist, create it before publishing.")
+            return None
+        status, js_resp = await self.request(
+            "POST", f"{self.user}.{tileset_name}/publish"
+        )
+        logging.info(f"{status}:{js_resp}")
+        if status == 200:
+            with open(recipe) as json_recipe:
+                record_applied(tileset_id, json.load(json_recipe))
+            return js_resp.get("jobId")
+
+    async def job_status(self, tileset_name, job_id):
+        """Returns the job information of a publish job."""
+        _, js_resp = await self.request(
+            "GET", f"{self.user}.{tileset_name}/jobs/{job_id}"
+        )
+        return js_resp
+
+    async def wait_for_job(self, tileset_name, job_id, interval=10):
+        """Polls a publish job until it leaves the queued/processing stages."""
+        while True:
+            job = await self.job_status(tileset_name, job_id)
+            if job.get("stage") not in ("queued", "processing"):
+                return job
+            await asyncio.sleep(interval)
+
+
+def write_ldgeojson(geo_file):
+    """Writes the normalized features of a geojson to a line delimited tempfile."""
+    file = tempfile.TemporaryFile()
+    for feature in iter_upload_features(geo_file):
+        file.write((json.dumps(feature, separators=(",", ":")) + "\n").encode("utf-8"))
+    file.seek(0)
+    return file
+
+
+async def run_all(operation, iterable, max_connections=100, **kwargs):
+    """
+    Async counterpart of mapbox_api.concurrent_runner. Runs the client method
+    named `operation` for every item, logging failures per item.
+    """
+    async with AsyncMapboxClient(max_connections=max_connections) as client:
+        func = getattr(client, operation)
+        items = list(iterable)
+        results = await asyncio.gather(
+            *(func(item, **kwargs) for item in items), return_exceptions=True
+        )
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            logging.error(f"Exception for {os.path.basename(item)}: {result}")
+        else:
+            logging.info(f"Successful operation for {os.path.basename(item)}.")
+    return dict(zip(items, results))
+
+
+def bulk_create_tileset_source(folder, replace=None, max_connections=20):
+    """Sync wrapper to upload all geojson files in a folder concurrently."""
+    files = get_files_full_path(folder)
+    return asyncio.run(
+        run_all("create_tileset_source", files, max_connections, replace=replace)
+    )
+
+
+def bulk_create_tilesets_from_recipes(recipe_folder, publish=True):
+    """Sync wrapper to create (and publish) tilesets for all recipes concurrently."""
+    recipes = get_files_full_path(recipe_folder, ".json")
+    return asyncio.run(run_all("create_tileset", recipes, publish=publish))
+
+
+def bulk_update_tileset_recipes(recipe_folder):
+    """Sync wrapper to update the recipe of all tilesets in a folder concurrently."""
+    recipes = get_files_full_path(recipe_folder, ".json")
+    return asyncio.run(run_all("update_tileset_recipe", recipes))
+
+
+def bulk_publish_tilesets_from_recipes(recipe_folder):
+    """Sync wrapper to publish all tilesets in a folder concurrently."""
+    recipes = get_files_full_path(recipe_folder, ".json")
+    return asyncio.run(run_all("publish_tileset", recipes))
+
+
+def bulk_refresh_recipes(recipe_folder):
+    """Updates and then publishes every recipe in a folder over one session."""
+
+    async def refresh(client, recipe):
+        # Publishing after a rejected update would record the new recipe as applied
+        if 200 <= await client.update_tileset_recipe(recipe) < 300:
+            return await client.publish_tileset(recipe)
+
+    async def main():
+        recipes = get_files_full_path(recipe_folder, ".json")
+        async with AsyncMapboxClient() as client:
+            return await asyncio.gather(
+                *(refresh(client, recipe) for recipe in recipes),
+                return_exceptions=True,
+            )
+
+    return asyncio.run(main())
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    recipe_folder = "recipes/"
+    bulk_refresh_recipes(recipe_folder)
+    t1 = time.time()
+    logging.info(f"Elapsed time: {t1-t0:.2f}s")
@@ -0,0 +1,289 @@
+"""
+Memory-budgeted scheduling. Estimates the memory a task needs from the input
+file size and geometry type, only admits work while the projected total fits
+the budget, and records the peak RSS growth per task to improve the estimates.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import resource
+import struct
+import threading
+
+fpath = os.path.dirname(os.path.abspath(__file__))
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+HISTORY_FILE = os.path.join(fpath, "data", "memory_history.json")
+HISTORY_LENGTH = 20  # (size, peak) samples kept per task kind and geometry type
+MIN_SAMPLES = 3  # Samples needed before fitted costs replace the defaults
+SAFETY_FACTOR = 1.2
+DEFAULT_OVERHEAD = 64 << 20  # Starting fixed memory of a task
+# Starting peak RSS per input byte until there is history for a task kind
+DEFAULT_FACTORS = {"Point": 6.0, "LineString": 8.0, "Polygon": 12.0, None: 12.0}
+SHP_TYPES = {1: "Point", 3: "LineString", 5: "Polygon", 8: "Point"}
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+history_lock = threading.Lock()
+
+
+def parse_size(size):
+    """Returns bytes from an int or a size string like 512M or 48G."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    number, unit = re.fullmatch(r"([\d.]+)\s*([KMGT]?)B?", size.upper()).groups()
+    return int(float(number) * UNITS.get(unit, 1))
+
+
+def input_size(file):
+    """Size of a file in bytes, including the .dbf attributes of a shapefile."""
+    size = os.path.getsize(file)
+    if file.endswith(".shp") and os.path.isfile(dbf := f"{file[:-4]}.dbf"):
+        size += os.path.getsize(dbf)
+    return size
+
+
+def geometry_type(file):
+    """
+    Returns Point, LineString or Polygon from the shapefile header, or the first
+    geometry of a geojson. Multi types count as their single part type.
+    """
+    if file.endswith(".shp"):
+        with open(file, "rb") as shp:
+            shp.seek(32)
+            shape_type = struct.unpack("<i", shp.read(4))[0]
+        return SHP_TYPES.get(shape_type % 10)
+    with open(file, encoding="utf-8", errors="ignore") as src:
+        head = src.read(1 << 16)
+    match = re.search(r'"type"\s*:\s*"(?:Multi)?(Point|LineString|Polygon)"', head)
+    return match.group(1) if match else None
+
+
+def load_history(history_file):
+    """Returns {kind: {geometry type: [[size, peak], ...]}} from the history file."""
+    if not os.path.isfile(history_file):
+        return {}
+    with open(history_file) as src:
+        history = json.load(src)
+    # Drops the per-byte ratios of the older history format
+    return {
+        kind: {
+            geom_type: [sample for sample in samples if isinstance(sample, list)]
+            for geom_type, samples in geom_types.items()
+        }
+        for kind, geom_types in history.items()
+    }
+
+
+class MemoryModel:
+    """
+    Peak RSS of a task as a fixed overhead plus a cost per input byte, fitted
+    per task kind and geometry type from the measured (size, peak) samples.
+    """
+
+    def __init__(self, history_file=HISTORY_FILE):
+        self.history_file = history_file
+        self.history = load_history(history_file)
+        self.pending = {}  # Samples recorded since the last save
+
+    def coefficients(self, kind, geom_type):
+        """Returns (overhead, cost per byte) of a task kind on a geometry type."""
+        default = DEFAULT_FACTORS.get(geom_type, DEFAULT_FACTORS[None])
+        with history_lock:
+            samples = list(self.history.get(kind, {}).get(str(geom_type), []))
+        if len(samples) < MIN_SAMPLES:
+            return DEFAULT_OVERHEAD, default
+
+        # Least squares fit of peak = overhead + cost * size
+        mean_size = sum(size for size, _ in samples) / len(samples)
+        mean_peak = sum(peak for _, peak in samples) / len(samples)
+        variance = sum((size - mean_size) ** 2 for size, _ in samples)
+        covariance = sum(
+            (size - mean_size) * (peak - mean_peak) for size, peak in samples
+        )
+        cost = max(covariance / variance, 0.0) if variance else default
+        # Raise the overhead to the largest underestimate so no sample is above
+        overhead = max(max(peak - cost * size for size, peak in samples), 0.0)
+        return overhead * SAFETY_FACTOR, cost * SAFETY_FACTOR
+
+    def estimate(self, kind, file, fraction=1.0):
+        """Estimated peak memory in bytes of a task on a fraction of a file."""
+        overhead, cost = self.coefficients(kind, geometry_type(file))
+        return int(overhead + cost * input_size(file) * fraction)
+
+    def record(self, kind, file, peak, fraction=1.0):
+        """Stores the measured peak RSS growth of a task to refine later estimates."""
+        size = input_size(file) * fraction
+        if not size or peak is None:
+            return
+        geom_type = str(geometry_type(file))
+        with history_lock:
+            for history in (self.history, self.pending):
+                samples = history.setdefault(kind, {}).setdefault(geom_type, [])
+                samples.append([size, peak])
+                del samples[:-HISTORY_LENGTH]
+
+    def save(self):
+        """
+        Merges the samples recorded since the last save into the history file, so
+        models of concurrent runs add to each other instead of overwriting.
+        """
+        with history_lock:
+            history = load_history(self.history_file)
+            for kind, geom_types in self.pending.items():
+                for geom_type, samples in geom_types.items():
+                    merged = history.setdefault(kind, {}).setdefault(geom_type, [])
+                    merged.extend(samples)
+                    del merged[:-HISTORY_LENGTH]
+            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+            tmp_file = f"{self.history_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as out:
+                json.dump(history, out, indent=4)
+            os.replace(tmp_file, self.history_file)
+            self.history = history
+            self.pending = {}
+
+
+class MemoryBudget:
+    """
+    Thread-safe memory accounting. acquire blocks until the amount fits the
+    budget. A task larger than the whole budget is still admitted when nothing
+    else is running so it cannot block forever.
+    """
+
+    def __init__(self, budget):
+        self.budget = parse_size(budget)
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def fits(self, amount):
+        return self.used == 0 or self.used + amount <= self.budget
+
+    def acquire(self, amount):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(amount))
+            if amount > self.budget:
+                logging.warning(f"Task needs {amount} bytes, over the whole budget.")
+            self.used += amount
+
+    def try_acquire(self, amount):
+        """Reserves the amount only if it fits right now. Returns True if it did."""
+        with self.condition:
+            if not self.fits(amount):
+                return False
+            self.used += amount
+            return True
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+def as_budget(budget):
+    """Returns budget as a MemoryBudget, keeping a shared instance as is."""
+    return budget if isinstance(budget, MemoryBudget) else MemoryBudget(budget)
+
+
+def budgeted(func, budget, model=None):
+    """
+    Wraps a single file function so it waits for its estimated memory in the
+    budget, for thread pools. Threads share one process, so no peak is recorded.
+    """
+    model = model or MemoryModel()
+
+    def run(file):
+        amount = model.estimate(func.__name__, file)
+        budget.acquire(amount)
+        try:
+            return func(file)
+        finally:
+            budget.release(amount)
+
+    return run
+
+
+def max_rss():
+    """Peak RSS of this process in bytes. ru_maxrss is in kilobytes on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    """Current RSS of this process in bytes, or the peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return max_rss()
+
+
+def measured_call(func, args):
+    """
+    Runs func in a fresh worker and returns (result, peak RSS growth in bytes).
+    A forked worker starts with the RSS of its parent, so the RSS at the start
+    of the task is subtracted from the peak.
+    """
+    start = current_rss()
+    result = func(*args)
+    return result, max(max_rss() - start, 0)
+
+
+def schedule(pool, func, tasks, estimates, budget, num_workers):
+    results = [None] * len(tasks)
+    peaks = [None] * len(tasks)
+    done = queue.Queue()
+    error = None
+    running = 0
+    pending = list(range(len(tasks)))
+    while (pending and error is None) or running:
+        # Admit tasks in order while a worker is free. Block on the budget only
+        # when none of ours run, as blocking while holding budget can deadlock
+        # callers sharing it. Otherwise collect a result first.
+        while pending and error is None and running < num_workers:
+            if running:
+                if not budget.try_acquire(estimates[pending[0]]):
+                    break
+            else:
+                budget.acquire(estimates[pending[0]])
+            index = pending.pop(0)
+            running += 1
+            pool.apply_async(
+                measured_call,
+                (func, tasks[index]),
+                callback=lambda result, i=index: done.put((i, result, None)),
+                error_callback=lambda exc, i=index: done.put((i, None, exc)),
+            )
+        index, result, exc = done.get()
+        running -= 1
+        budget.release(estimates[index])
+        if exc is not None:
+            # Drain the running tasks so a shared budget is fully released
+            error = error or exc
+        else:
+            results[index], peaks[index] = result
+    if error is not None:
+        raise error
+    return results, peaks
+
+
+def run_budgeted(func, tasks, estimates, budget, num_workers=5, pool=None):
+    """
+    Runs func(*task) for every task in a process pool, starting a task only
+    while the estimated memory of the running tasks fits the budget. Workers
+    are replaced after every task so ru_maxrss is the peak of that task.
+
+    Args:
+        budget (int|str|MemoryBudget): Budget in bytes or i.e. "64G". Pass one
+                                       MemoryBudget to share it between
+                                       concurrent calls.
+        pool (multiprocessing.Pool): Optional long-lived pool, created with
+                                     maxtasksperchild=1 for exact peaks.
+
+    Returns:
+        (list, list): Results and measured peak RSS growth, in task order.
+    """
+    budget = as_budget(budget)
+    if pool is not None:
+        return schedule(pool, func, tasks, estimates, budget, num_workers)
+    with multiprocessing.Pool(num_workers, maxtasksperchild=1) as pool:
+        return schedule(pool, func, tasks, estimates, budget, num_workers)
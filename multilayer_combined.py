@@ -1,56 +1,153 @@
 import json
+import logging
 import os
+import re
 import time
 
-from multilayer_processor import create_multilayer_tileset
+from inventory import get_inventory
+from mapbox_api import concurrent_runner, get_files_full_path
+from multilayer_processor import sync_multilayer_tileset
+from recipe_diff import write_recipe
 
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 RECIPES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes")
+MAX_LAYERS = 20  # MTS limit of layers per recipe
+MAX_SHARD_SIZE = None  # Optional limit of summed source sizes per recipe, in bytes
 
 
-def generate_combined_recipe():
-    """Function generate multilayer recipe."""
+def index_sources(sources, hazard_types):
+    """
+    Groups sources by hazard in one pass over the source list. A source belongs
+    to a hazard if the hazard is one of the underscore separated tokens of its
+    <region>_<hazard type>_<hazard level> name, i.e. ph01_lh_lh2 has the tokens
+    ph01, lh and lh2. Hazard types are matched case-insensitively.
+    """
+    hazards = {hazard.lower() for hazard in hazard_types}
+    index = {hazard: [] for hazard in hazards}
+    for source in sources:
+        source_name = source["url"].split("/")[-1].lower()
+        for token in hazards.intersection(source_name.split("_")):
+            index[token].append(source)
+    return index
+
+
+def shard_sources(sources, max_layers=MAX_LAYERS, max_size=MAX_SHARD_SIZE):
+    """
+    Splits sources into shards of at most max_layers, and at most max_size
+    summed source size when the sources list their "size".
+    """
+    shards = [[]]
+    shard_size = 0
+    for source in sources:
+        size = source.get("size", 0)
+        full = len(shards[-1]) >= max_layers
+        too_big = max_size is not None and shard_size + size > max_size
+        if shards[-1] and (full or too_big):
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(source)
+        shard_size += size
+    return shards
+
+
+def shard_recipe_names(hazard, count):
+    recipe_name = f"ph_{hazard.lower()}"
+    if count == 1:
+        return [recipe_name]
+    return [f"{recipe_name}_s{n}" for n in range(1, count + 1)]
+
+
+def remove_stale_shards(hazard, recipe_names):
+    """
+    Removes shard recipes of a previous run with a different shard count, and
+    warns about their tilesets that are still published with stale data.
+
+    Returns:
+        list: Ids of the orphaned remote tilesets, to be deleted by hand.
+    """
+    pattern = re.compile(rf"ph_{hazard.lower()}(_s\d+)?")
+    for recipe in os.listdir(RECIPES_FOLDER):
+        name, ext = os.path.splitext(recipe)
+        if ext == ".json" and pattern.fullmatch(name) and name not in recipe_names:
+            os.remove(os.path.join(RECIPES_FOLDER, recipe))
+
+    user = os.getenv("USER")
+    current = {f"{user}.{recipe_name}_tls" for recipe_name in recipe_names}
+    orphans = sorted(
+        tileset_id
+        for tileset_id in get_inventory()["tilesets"]
+        if tileset_id.startswith(f"{user}.")
+        and tileset_id.endswith("_tls")
+        and pattern.fullmatch(tileset_id[len(user) + 1 : -4])
+        and tileset_id not in current
+    )
+    for tileset_id in orphans:
+        logging.warning(f"{tileset_id} is no longer generated and has stale data.")
+    return orphans
+
+
+def generate_combined_recipe(
+    hazard_types=("lh",), max_layers=MAX_LAYERS, max_size=MAX_SHARD_SIZE
+):
+    """
+    Function generate multilayer recipe. Layers that don't fit MTS limits are
+    split across multiple recipes, ph_<hazard>_s1, ph_<hazard>_s2, ...
+
+    Returns:
+        list: (recipe name, recipe path) of every generated recipe.
+    """
 
     with open("data/lh2.json") as f:  # array of tileset source
         js = json.load(f)
 
-    hazard_types = [
-        "lh"
-    ]  # noqa: E501
-    for hazard in hazard_types:
-        layers = {}
-        for source in js:
-            layer_config = {
-                "minzoom": 5,
-                "maxzoom": 10,
-                "features": {"simplification": ["case", [">=", ["zoom"], 10], 0, 20]},
-            }
-
-            if hazard in (source_url := source["url"]):
-                # print(source_url)
-                layer_config["source"] = source_url
+    recipes = []
+    for hazard, sources in index_sources(js, hazard_types).items():
+        if not sources:
+            logging.warning(f"No sources found for {hazard}, skipping it.")
+            continue
+        shards = shard_sources(sources, max_layers, max_size)
+        recipe_names = shard_recipe_names(hazard, len(shards))
+        remove_stale_shards(hazard, recipe_names)
+        for recipe_name, shard in zip(recipe_names, shards):
+            layers = {}
+            for source in shard:
+                layer_config = {
+                    "minzoom": 5,
+                    "maxzoom": 10,
+                    "features": {
+                        "simplification": ["case", [">=", ["zoom"], 10], 0, 20]
+                    },
+                }
+                layer_config["source"] = source["url"]
                 layer_key = source["url"].split("/")[-1]
                 layers[layer_key] = layer_config
 
-        recipe = {"version": 1, "layers": layers}
-        with open(f"recipes/ph_{hazard.lower()}.json", "w") as rcp:
-            json.dump(recipe, rcp, indent=4)
+            recipe = {"version": 1, "layers": layers}
+            recipe_path = os.path.join(RECIPES_FOLDER, f"{recipe_name}.json")
+            write_recipe(recipe, recipe_path)
+            recipes.append((recipe_name, recipe_path))
+    return recipes
 
 
-def create_combined_tileset():
+def create_combined_tileset(recipe_paths=None, num_workers=5):
     """
     Function to process and publish multilayer
-    tileset using multiple source reciper.
+    tileset using multiple source reciper. Tilesets whose recipe and sources
+    are unchanged since the last publish are skipped. Recipes, i.e. the shards
+    of a hazard, are processed concurrently.
     """
-    recipes = os.listdir(RECIPES_FOLDER)
+    if recipe_paths is None:
+        recipe_paths = get_files_full_path(RECIPES_FOLDER, ".json")
+
+    def sync(recipe_url):
+        recipe_name = os.path.basename(recipe_url).rsplit(".", 1)[0]
+        return sync_multilayer_tileset(recipe_name, recipe_url)
 
-    for recipe in recipes:
-        recipe_name = recipe.rsplit(".", 1)[0]
-        recipe_url = f"{RECIPES_FOLDER}/{recipe}"
-        create_multilayer_tileset(recipe_name, recipe_url)
+    concurrent_runner(sync, recipe_paths, num_workers=num_workers)
 
 
 if __name__ == "__main__":
     t0 = time.time()
-    generate_combined_recipe()
-    create_combined_tileset()
+    recipes = generate_combined_recipe()
+    create_combined_tileset([recipe_path for _, recipe_path in recipes])
     sleep_counter = 0
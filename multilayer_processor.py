@@ -2,12 +2,23 @@
 import json
 import logging
 import os
+import re
 import time
 
-import requests
 from dotenv import load_dotenv
 
+from http_session import session
+from inventory import mark_created, tileset_exists
 from mapbox_api import bulk_create_tileset_source
+from recipe_diff import (
+    CREATE,
+    PUBLISH,
+    UPDATE,
+    load_state,
+    plan_action,
+    record_applied,
+    write_recipe,
+)
 
 load_dotenv()
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
@@ -43,30 +54,69 @@ def generate_multilayer_recipe(multilayer_folder):  # On top for visibility
 
     geojson_dict = {"version": 1, "layers": layer}
 
-    with open(
-        recipe_path := os.path.join(RECIPES_FOLDER, f"{recipe_name}.json"), "w"
-    ) as recipe_file:
-        json.dump(geojson_dict, recipe_file, indent=4)
+    recipe_path = os.path.join(RECIPES_FOLDER, f"{recipe_name}.json")
+    write_recipe(geojson_dict, recipe_path)
     return recipe_name, recipe_path
 
 
-def publish_multilayer_tileset(recipe):
+def publish_multilayer_tileset(recipe, recipe_url=None):
     """Function to process and publish created tileset."""
     tileset_name = recipe + "_tls"
+    if not tileset_exists(f"{os.getenv('USER')}.{tileset_name}", refresh_on_miss=True):
+        logging.info(f"{tileset_name} does not exist, create it before publishing.")
+        return False
     url = f"https://api.mapbox.com/tilesets/v1/{os.getenv('USER')}.{tileset_name}/publish?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
-    response = requests.request("POST", url=url)
+    response = session.request("POST", url=url)
     logging.info(f"{response.status_code}:{response.text}")
     if response.status_code != 200:
         logging.info(f"retrying {tileset_name}")
         time.sleep(30)
-        response = requests.request("POST", url=url)
+        response = session.request("POST", url=url)
         logging.info(f"retried {tileset_name}: {response.status_code}:{response.text}")
 
+    if response.status_code == 200 and recipe_url is not None:
+        tileset_id = f"{os.getenv('USER')}.{tileset_name}"
+        with open(recipe_url) as json_recipe:
+            record_applied(tileset_id, json.load(json_recipe))
+    return response.status_code == 200
+
+
+def update_multilayer_recipe(recipe, recipe_url):
+    """Function to update the recipe of a multi layer tileset."""
+    tileset_name = recipe + "_tls"
+    url = f"https://api.mapbox.com/tilesets/v1/{os.getenv('USER')}.{tileset_name}/recipe?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
+    with open(recipe_url) as json_recipe:
+        payload = json.load(json_recipe)
+    response = session.request("PATCH", url=url, json=payload)
+    logging.info(f"{response.status_code}:{response.text}")
+    # The recipe endpoint answers 201/204 on success
+    return response.ok
+
+
+def sync_multilayer_tileset(recipe, recipe_url):
+    """
+    Creates, updates or publishes a multi layer tileset only if the recipe or its
+    sources changed since the last publish. Returns the action taken.
+    """
+    tileset_id = f"{os.getenv('USER')}.{recipe}_tls"
+    with open(recipe_url) as json_recipe:
+        action = plan_action(tileset_id, json.load(json_recipe), load_state())
+    logging.info(f"{tileset_id}: {action}")
+    if action == CREATE:
+        create_multilayer_tileset(recipe, recipe_url)
+    elif action == UPDATE:
+        if update_multilayer_recipe(recipe, recipe_url):
+            publish_multilayer_tileset(recipe, recipe_url)
+    elif action == PUBLISH:
+        publish_multilayer_tileset(recipe, recipe_url)
+    return action
+
 
 def create_multilayer_tileset(recipe, recipe_url, publish=True):
     """
     Function to create an empty tileset using a multi layer recipe. Need to publish
-    tileset for it to be usable.
+    tileset for it to be usable. If the tileset already exists in the inventory,
+    its recipe is updated instead.
     Args:
         recipe (str): recipe name to be set as tileset and mapbox name.
         recipe_url (str): Full path of the recipe file.
@@ -75,7 +125,9 @@ def create_multilayer_tileset(recipe, recipe_url, publish=True):
                         operations explicitly.
     """
     tileset_name = f"{recipe}_tls"  # Mapbox tileset identifier
-    mapbox_name = recipe.replace("_", " ")  # Mapbox verbose name
+    # Shards of a sharded recipe are suffixed with _s<n>, see multilayer_combined
+    base_recipe, shard = re.fullmatch(r"(.*?)(?:_s(\d+))?", recipe).groups()
+    mapbox_name = base_recipe.replace("_", " ")  # Mapbox verbose name
     haz_lvl = mapbox_name.split()[-1]
 
     if "ph" in mapbox_name:
@@ -90,8 +142,10 @@ def create_multilayer_tileset(recipe, recipe_url, publish=True):
         else:
             mapbox_name = f"PH Buildings {haz_lvl.upper()}"
     else:
-        mapbox_name = recipe
-    
+        mapbox_name = base_recipe
+    if shard:
+        mapbox_name = f"{mapbox_name} Part {shard}"
+
     url = f"https://api.mapbox.com/tilesets/v1/{os.getenv('USER')}.{tileset_name}?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
     payload = {}
     payload["name"] = mapbox_name
@@ -100,17 +154,29 @@ def create_multilayer_tileset(recipe, recipe_url, publish=True):
     with open(recipe_url) as json_recipe:
         payload["recipe"] = json.load(json_recipe)
 
-    response = requests.request("POST", url=url, json=payload)
-    logging.info(response.text)
-    if response.status_code != 200:
-        logging.info(f"retrying {tileset_name}")
-        time.sleep(30)
-        response = requests.request("POST", url=url, json=payload)
-        logging.info(f"retried {tileset_name}: {response.status_code}:{response.text}")
+    if tileset_exists(tileset_id := f"{os.getenv('USER')}.{tileset_name}"):
+        logging.info(f"{tileset_id} already exists, updating recipe instead.")
+        if not update_multilayer_recipe(recipe, recipe_url):
+            # Publishing now would record a recipe that was never applied
+            logging.info(f"Recipe update of {tileset_id} failed, not publishing.")
+            return False
+    else:
+        response = session.request("POST", url=url, json=payload)
+        logging.info(response.text)
+        if response.status_code != 200:
+            logging.info(f"retrying {tileset_name}")
+            time.sleep(30)
+            response = session.request("POST", url=url, json=payload)
+            logging.info(
+                f"retried {tileset_name}: {response.status_code}:{response.text}"
+            )
+        if response.status_code != 200:
+            return False
+        mark_created("tilesets", tileset_id)
 
     # Run publish
     if publish:
-        publish_multilayer_tileset(recipe)
+        return publish_multilayer_tileset(recipe, recipe_url)
 
 
 def bulk_upload_pipeline(multilayer_folder):
@@ -119,7 +185,7 @@ def bulk_upload_pipeline(multilayer_folder):
     # print(geo_folder)
     # bulk_create_tileset_source(geo_folder)
     recipe, recipe_url = generate_multilayer_recipe(multilayer_folder)
-    create_multilayer_tileset(recipe, recipe_url)
+    sync_multilayer_tileset(recipe, recipe_url)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+"""Splits nationwide layers into per-region folders used by the processors"""
+import logging
+import multiprocessing
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import geo_cache
+
+fpath = os.path.dirname(os.path.abspath(__file__))
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+GEOJSON_FOLDER = os.path.join(fpath, "data/geojson")
+REGION_COLUMN = "ADM1_PCODE"  # Region code column of the boundary file, i.e. PH01
+
+
+def make_grid(bounds, cell_size, region_column=REGION_COLUMN):
+    """Creates a tile grid over bounds to partition by instead of regions."""
+    minx, miny, maxx, maxy = bounds
+    xs = np.arange(np.floor(minx / cell_size), np.ceil(maxx / cell_size))
+    ys = np.arange(np.floor(miny / cell_size), np.ceil(maxy / cell_size))
+    cols, rows = [a.ravel() for a in np.meshgrid(xs.astype(int), ys.astype(int))]
+    boxes = shapely.box(
+        cols * cell_size,
+        rows * cell_size,
+        (cols + 1) * cell_size,
+        (rows + 1) * cell_size,
+    )
+    names = [f"grid_{col}_{row}" for col, row in zip(cols, rows)]
+    return gpd.GeoDataFrame({region_column: names}, geometry=boxes, crs="EPSG:4326")
+
+
+def assign_regions(gdf, boundaries, region_column=REGION_COLUMN):
+    """
+    Returns the region of every feature using an STRtree of the boundary polygons.
+    Features are assigned by a point inside the geometry so they land in exactly
+    one region. Points outside all boundaries (i.e. offshore) go to the nearest.
+    """
+    tree = shapely.STRtree(boundaries.geometry.values)
+    points = gdf.geometry.representative_point().values
+    feature_idx, region_idx = tree.query(points, predicate="within")
+
+    assigned = np.full(len(gdf), -1, dtype=np.int64)
+    # Keep the first match for points on shared borders
+    assigned[feature_idx[::-1]] = region_idx[::-1]
+    missing = np.flatnonzero(assigned < 0)
+    if len(missing):
+        nearest_feature, nearest_region = tree.query_nearest(points[missing])
+        assigned[missing[nearest_feature]] = nearest_region
+    return boundaries[region_column].to_numpy()[assigned]
+
+
+def write_partition(part_gdf, output_file):
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    part_gdf.to_file(output_file, driver="GeoJSON")
+    logging.info(f"Wrote {len(part_gdf)} features to {output_file}")
+    return output_file
+
+
+def partition_file(
+    input_file,
+    hazard_type,
+    hazard_level,
+    boundaries_file=None,
+    cell_size=None,
+    region_column=REGION_COLUMN,
+    geo_folder=GEOJSON_FOLDER,
+    num_cores=5,
+):
+    """
+    Partitions a nationwide geojson or shapefile into
+    <geo_folder>/<region>/<hazard_type>/<hazard_level>/<region>_<filename>.geojson.
+    The region prefix keeps the source names of the regions apart.
+
+    Args:
+        input_file (str): Nationwide geojson or shapefile.
+        hazard_type (str): Hazard type folder, i.e. FH.
+        hazard_level (str): Hazard level folder, i.e. 100yr.
+        boundaries_file (str): Region boundary polygons with a region_column.
+        cell_size (float): Partition by a tile grid of this size in degrees
+                           instead of boundaries.
+    """
+    if boundaries_file is None and cell_size is None:
+        raise ValueError("Either boundaries_file or cell_size is required")
+
+    logging.info(f"Partitioning {input_file}.")
+    gdf = geo_cache.read_file(input_file).to_crs(epsg=4326)
+    gdf = gdf[~(gdf.geometry.is_empty | gdf.geometry.isna())]
+    if boundaries_file is not None:
+        boundaries = gpd.read_file(boundaries_file).to_crs(epsg=4326)
+    else:
+        boundaries = make_grid(gdf.total_bounds, cell_size, region_column)
+
+    regions = assign_regions(gdf, boundaries, region_column)
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    tasks = [
+        (
+            gdf[regions == region],
+            os.path.join(
+                geo_folder,
+                region,
+                hazard_type,
+                hazard_level,
+                f"{region}_{stem}.geojson",
+            ),
+        )
+        for region in np.unique(regions)
+    ]
+    with multiprocessing.Pool(num_cores) as pool:
+        return pool.starmap(write_partition, tasks)
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    input_file = "data/nationwide/PH_FH_100yr.shp"
+    boundaries_file = "data/boundaries/ph_regions.shp"
+    partition_file(input_file, "FH", "100yr", boundaries_file=boundaries_file)
+    t1 = time.time()
+    logging.info(f"Elapsed time: {t1-t0:.2f}s")
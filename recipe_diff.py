@@ -0,0 +1,157 @@
+"""Tracks applied recipes and uploaded sources to only run the MTS jobs needed"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from http_session import session
+from inventory import tileset_exists
+
+load_dotenv()
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+fpath = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(fpath, "data", "recipe_state.json")
+NOOP, UPDATE, PUBLISH, CREATE = "noop", "update", "publish", "create"
+state_lock = threading.Lock()
+
+
+def canonical_recipe(recipe):
+    """Returns the recipe as JSON text with sorted keys and no whitespace."""
+    return json.dumps(recipe, sort_keys=True, separators=(",", ":"))
+
+
+def recipe_hash(recipe):
+    return hashlib.sha256(canonical_recipe(recipe).encode("utf-8")).hexdigest()
+
+
+def file_hash(file, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(file, "rb") as src:
+        while chunk := src.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_recipe(recipe, recipe_path):
+    """
+    Writes a recipe unless the file already has the same canonical content, so
+    regenerating recipes does not touch unchanged files. Returns True if written.
+    """
+    if os.path.isfile(recipe_path):
+        with open(recipe_path) as recipe_file:
+            try:
+                if canonical_recipe(json.load(recipe_file)) == canonical_recipe(
+                    recipe
+                ):
+                    return False
+            except ValueError:
+                pass
+    with open(recipe_path, "w") as recipe_file:
+        json.dump(recipe, recipe_file, indent=4)
+    return True
+
+
+def load_state():
+    if not os.path.isfile(STATE_FILE):
+        return {"sources": {}, "tilesets": {}}
+    with open(STATE_FILE) as state_file:
+        return json.load(state_file)
+
+
+def update_state(func):
+    """Applies func to the state and saves it, safe to call from thread pools."""
+    with state_lock:
+        state = load_state()
+        func(state)
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        with open(tmp_file := f"{STATE_FILE}.tmp", "w") as state_file:
+            json.dump(state, state_file, indent=4, sort_keys=True)
+        os.replace(tmp_file, STATE_FILE)
+
+
+def record_source_upload(source_id, *geo_files):
+    """
+    Records the content hash of the geojson uploaded as tileset source. A source
+    appended from several files gets one hash of their sorted file hashes.
+    """
+    if len(geo_files) == 1:
+        content_hash = file_hash(geo_files[0])
+    else:
+        file_hashes = ",".join(sorted(file_hash(file) for file in geo_files))
+        content_hash = hashlib.sha256(file_hashes.encode("utf-8")).hexdigest()
+
+    def record(state):
+        state["sources"][source_id] = {"hash": content_hash, "uploaded": time.time()}
+
+    update_state(record)
+
+
+def record_applied(tileset_id, recipe):
+    """Records the recipe and source versions of a successfully published tileset."""
+
+    def record(state):
+        state["tilesets"][tileset_id] = {
+            "recipe_hash": recipe_hash(recipe),
+            "sources": source_versions(state, recipe),
+            "published": time.time(),
+        }
+
+    update_state(record)
+
+
+def recipe_sources(recipe):
+    return sorted({layer["source"] for layer in recipe["layers"].values()})
+
+
+def source_versions(state, recipe):
+    return {
+        source: state["sources"][source]["hash"]
+        for source in recipe_sources(recipe)
+        if source in state["sources"]
+    }
+
+
+def fetch_remote_recipe(tileset_id):
+    """Returns the recipe currently applied to a tileset, None if it doesn't exist."""
+    url = f"https://api.mapbox.com/tilesets/v1/{tileset_id}/recipe?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
+    response = session.request("GET", url=url)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()["recipe"]
+
+
+def plan_action(tileset_id, recipe, state=None):
+    """
+    Compares a recipe against the last applied version, kept in the local state
+    or fetched from the API when there is no local record.
+
+    Returns:
+        str: One of
+            noop: recipe and sources are unchanged.
+            update: the recipe changed, update the recipe and publish.
+            publish: only a source was uploaded again since the last publish.
+            create: the tileset does not exist yet.
+    """
+    state = state or load_state()
+    applied = state["tilesets"].get(tileset_id)
+    if applied is None:
+        if not tileset_exists(tileset_id):
+            return CREATE
+        remote = fetch_remote_recipe(tileset_id)
+        if remote is None:
+            return CREATE
+        if recipe_hash(remote) != recipe_hash(recipe):
+            return UPDATE
+        applied = {"recipe_hash": recipe_hash(remote), "sources": {}}
+    elif applied["recipe_hash"] != recipe_hash(recipe):
+        return UPDATE
+
+    uploaded = source_versions(state, recipe)
+    if any(applied["sources"].get(src) != ver for src, ver in uploaded.items()):
+        return PUBLISH
+    return NOOP
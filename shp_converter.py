@@ -2,38 +2,232 @@ import logging
 import multiprocessing
 import os
 import json
+import shutil
+import tempfile
 import geopandas as gpd
 
+import geo_cache
+from memory_budget import MemoryModel, run_budgeted
+from validator import CLASS_COLUMN, repair_geodataframe, validate_geodataframe
+
 fpath = os.path.dirname(os.path.abspath(__file__))
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+CHUNK_ROWS = 50000  # Shapefiles with more records are converted in parallel chunks
+SEQ_EXTENSIONS = (".ldgeojson", ".geojsonl", ".geojsons")  # Line delimited outputs
 
 
-def generate_file_paths(shp_folder, geo_folder):
+def generate_file_paths(shp_folder, geo_folder, ext=".geojson"):
     file_paths = []
     for file in os.listdir(shp_folder):
         if file.endswith(".shp"):
             paths = (
                 os.path.join(fpath, shp_folder, file),
-                dst := os.path.join(fpath, geo_folder, f"{file.split('.')[0]}.geojson"),
+                dst := os.path.join(fpath, geo_folder, f"{file.split('.')[0]}{ext}"),
             )
             if not os.path.isfile(dst):  # Do not regenerate existing geojson
                 file_paths.append(paths)
     return file_paths
 
 
-def shp_to_geojson(input_shp, output_file):
-    logging.info(f"Processing {input_shp}.")
-    shp = gpd.read_file(input_shp)
-    shp2wgs = shp.to_crs(epsg=4326)
-    print(shp2wgs.columns)
-    # Add here the function to check if file has correct var column
-    shp2wgs.to_file(output_file, driver="GeoJSON")
+def shp_to_geojson(input_shp, output_file, **kwargs):
+    """
+    Converts a single shapefile. Takes the options of convert_folder_contents,
+    which does the validation and writing for every conversion.
+    """
+    return convert_folder_contents([(input_shp, output_file)], **kwargs)
+
+
+def count_records(input_shp):
+    """Returns the number of records of a shapefile from its .shx index."""
+    shx = f"{os.path.splitext(input_shp)[0]}.shx"
+    if os.path.isfile(shx):
+        return (os.path.getsize(shx) - 100) // 8  # 100 byte header, 8 byte records
+    return len(gpd.read_file(input_shp, ignore_geometry=True))
+
+
+def check_chunk(gdf, class_column=CLASS_COLUMN, validate=True):
+    """Returns the validation report, or a passing one if validation is off."""
+    if validate:
+        return validate_geodataframe(gdf, class_column)
+    return {"features": len(gdf), "errors": {}, "valid": True}
+
+
+def convert_chunk(
+    input_shp,
+    rows,
+    chunk_file,
+    repair=False,
+    cache=None,
+    part=0,
+    class_column=CLASS_COLUMN,
+    validate=True,
+):
+    """
+    Reads and reprojects a row range of a shapefile into a line delimited file,
+    and into part of the GeoParquet cache folder if given.
+    """
+    chunk = gpd.read_file(input_shp, rows=rows).to_crs(epsg=4326)
+    if repair:
+        chunk = repair_geodataframe(chunk, class_column)
+    report = check_chunk(chunk, class_column, validate)
+    if report["valid"] and len(chunk):
+        chunk.to_file(chunk_file, driver="GeoJSONSeq")
+        if cache:
+            geo_cache.write_cache(chunk, cache, part)
+    return report
+
+
+def merge_chunks(chunk_files, output_file, cache=None):
+    """
+    Merges the chunk files in order into one geojson, or a line delimited geojson
+    if output_file has one of the SEQ_EXTENSIONS.
+    """
+    seq = output_file.endswith(SEQ_EXTENSIONS)
+    separator = "\n" if seq else ",\n"
+    first = True
+    with open(output_file, "w", encoding="utf-8") as out:
+        if not seq:
+            out.write('{"type": "FeatureCollection", "features": [\n')
+        for chunk_file in chunk_files:
+            if not os.path.isfile(chunk_file):  # Chunk without features
+                continue
+            with open(chunk_file, encoding="utf-8") as src:
+                for line in src:
+                    if not (line := line.strip().lstrip("\x1e")):
+                        continue
+                    if not first:
+                        out.write(separator)
+                    out.write(line)
+                    first = False
+        out.write("\n" if seq else "\n]}\n")
+    if cache and os.path.isdir(cache):
+        geo_cache.touch(cache)  # The cache parts predate the merged output
     logging.info(f"Converted to {output_file}")
-
-
-def convert_folder_contents(paths, num_cores=5):
-    with multiprocessing.Pool(num_cores) as pool:
-        pool.starmap(shp_to_geojson, paths)
+    return output_file
+
+
+def chunk_fraction(input_shp, rows):
+    total = max(count_records(input_shp), 1)
+    return max(min(rows.stop, total) - rows.start, 1) / total
+
+
+def run_chunks_budgeted(tasks, memory_budget, num_cores, pool=None, model=None):
+    """
+    Converts chunks only while their estimated memory fits the budget, and records
+    the peak RSS of every chunk to improve the estimates of later runs.
+    """
+    model = model or MemoryModel()
+    fractions = [chunk_fraction(task[0], task[1]) for task in tasks]
+    estimates = [
+        model.estimate("convert_chunk", task[0], fraction)
+        for task, fraction in zip(tasks, fractions)
+    ]
+    reports, peaks = run_budgeted(
+        convert_chunk, tasks, estimates, memory_budget, num_cores, pool
+    )
+    for task, fraction, peak in zip(tasks, fractions, peaks):
+        model.record("convert_chunk", task[0], peak, fraction)
+    model.save()
+    return reports
+
+
+def run_conversion(
+    pool, tasks, file_chunks, memory_budget=None, num_cores=5, memory_model=None
+):
+    if memory_budget is None:
+        reports = pool.starmap(convert_chunk, tasks, chunksize=1)
+    else:
+        reports = run_chunks_budgeted(
+            tasks, memory_budget, num_cores, pool, memory_model
+        )
+    reports = iter(reports)
+    merges = []
+    rejected = []
+    for input_shp, output_file, chunk_files, cache in file_chunks:
+        chunk_reports = [next(reports) for _ in chunk_files]
+        if not all(report["valid"] for report in chunk_reports):
+            errors = [r["errors"] for r in chunk_reports if not r["valid"]]
+            logging.error(f"Rejected {input_shp}, failed validation: {errors}")
+            if cache:
+                geo_cache.clear_cache(cache)
+            rejected.append(input_shp)
+            continue
+        merges.append((chunk_files, output_file, cache))
+    outputs = pool.starmap(merge_chunks, merges, chunksize=1)
+    if rejected:
+        raise ValueError(
+            f"{len(rejected)} of {len(file_chunks)} shapefiles failed validation "
+            f"and were not converted: {', '.join(rejected)}"
+        )
+    return outputs
+
+
+def convert_folder_contents(
+    paths,
+    num_cores=5,
+    chunk_rows=CHUNK_ROWS,
+    repair=False,
+    cache=False,
+    pool=None,
+    memory_budget=None,
+    memory_model=None,
+    class_column=CLASS_COLUMN,
+    validate=True,
+):
+    """
+    Converts (shapefile, output) pairs across a process pool. Shapefiles larger
+    than chunk_rows records are split into row-range chunks so one nationwide file
+    uses every core. Files are scheduled largest first so a big file doesn't end
+    up running alone at the tail. Pass a long-lived multiprocessing pool to reuse
+    warm workers instead of starting num_cores new ones. With cache, a GeoParquet
+    copy of the reprojected data is written for each output, see geo_cache.
+    With a memory_budget (bytes or i.e. "64G"), chunks only start while their
+    estimated memory fits, so num_cores can be raised without OOM kills. Callers
+    converting concurrently should share one MemoryBudget and MemoryModel, and
+    a pool created with maxtasksperchild=1 so the chunk peaks are exact.
+    Every file is validated against class_column (None skips the attribute
+    checks) unless validate is False. Files that fail are not written, and a
+    ValueError listing them is raised after the valid files are converted.
+    """
+    paths = sorted(paths, key=lambda path: os.path.getsize(path[0]), reverse=True)
+    tmp_dir = tempfile.mkdtemp(prefix="shp_chunks_")
+    tasks = []
+    file_chunks = []
+    for index, (input_shp, output_file) in enumerate(paths):
+        cache_dir = geo_cache.cache_path(output_file) if cache else None
+        if cache_dir:
+            geo_cache.clear_cache(cache_dir)
+        chunk_files = []
+        for start in range(0, max(count_records(input_shp), 1), chunk_rows):
+            part = len(chunk_files)
+            chunk_file = os.path.join(tmp_dir, f"{index}_{part}.geojsonl")
+            rows = slice(start, start + chunk_rows)
+            tasks.append(
+                (
+                    input_shp,
+                    rows,
+                    chunk_file,
+                    repair,
+                    cache_dir,
+                    part,
+                    class_column,
+                    validate,
+                )
+            )
+            chunk_files.append(chunk_file)
+        file_chunks.append((input_shp, output_file, chunk_files, cache_dir))
+        logging.info(f"Processing {input_shp} in {len(chunk_files)} chunks.")
+
+    conversion = (tasks, file_chunks, memory_budget, num_cores, memory_model)
+    # Budgeted chunks get a fresh worker each so their peak RSS is measurable
+    maxtasksperchild = None if memory_budget is None else 1
+    try:
+        if pool is not None:
+            return run_conversion(pool, *conversion)
+        with multiprocessing.Pool(num_cores, maxtasksperchild=maxtasksperchild) as pool:
+            return run_conversion(pool, *conversion)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -44,7 +238,7 @@ if __name__ == "__main__":
     # convert_folder_contents(paths)
     shp_file = "/home/noahdev-hpc/Documents/git/random_processor/output/merged_df.shp"
     geojson_file = "/home/noahdev-hpc/Documents/git/mapbox-processor/data/geojson/LH/LH22024/PH_LH_DF.geojson"
-    shp_to_geojson(shp_file, geojson_file)
+    convert_folder_contents([(shp_file, geojson_file)])
 
 
 
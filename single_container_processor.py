@@ -5,17 +5,19 @@ import os
 import tempfile
 import time
 
-import requests
 from dotenv import load_dotenv
 from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 
+from http_session import session
+from inventory import mark_created
 from mapbox_api import (
     concurrent_runner,
     create_callback,
     create_tileset,
     get_files_full_path,
+    iter_upload_features,
 )
-from utils import normalize
+from recipe_diff import record_source_upload
 
 load_dotenv()
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
@@ -58,14 +60,15 @@ def create_multilayer_tls_src(geo_file, replace=False):
     Args:
         geo_file (str): Full path of the geojson being uploaded
         replace (bool): Defaults to False. Setting to True will enable the script to
-                        replace the source file.
+                        replace the source file. Every file of the container
+                        appends to the same source, so leave it False.
     """
     # reg = os.path.dirname(geo_file).split("/")[-3]
     # haztype = os.path.dirname(geo_file).split("/")[-2]
     # hazlevel = os.path.dirname(geo_file).split("/")[-1]
     source_name = f"{region}_{hazard_type}_{hazard_level}"
     url = f"https://api.mapbox.com/tilesets/v1/sources/{os.getenv('USER')}/{source_name}?access_token={os.getenv('MAPBOX_ACCESS_TOKEN')}"  # noqa: E501
-    features = normalize(geo_file)
+    features = iter_upload_features(geo_file)
     with tempfile.TemporaryFile() as file:
         for feature in features:
             file.write(
@@ -81,7 +84,7 @@ def create_multilayer_tls_src(geo_file, replace=False):
         if replace:
             method = "PUT"
 
-        response = requests.request(
+        response = session.request(
             method,
             url,
             data=monitor,
@@ -90,13 +93,26 @@ def create_multilayer_tls_src(geo_file, replace=False):
                 "Content-type": monitor.content_type,
             },
         )
-        logging.info(response.json())
+        logging.info(js_resp := response.json())
+
+    if response.status_code == 200:
+        mark_created("sources", js_resp.get("id"))
+        return js_resp.get("id")
 
 
 def bulk_multilayer_tls_src(folder):
-    """Bulk process in createing tileset source"""
+    """
+    Bulk process in createing tileset source. The container's source version is
+    recorded once over all its files, and only if every upload succeeded.
+    """
     files = get_files_full_path(folder)
-    concurrent_runner(create_multilayer_tls_src, files)
+    results = concurrent_runner(create_multilayer_tls_src, files)
+    source_ids = {results.get(file) for file in files}
+    if None in source_ids:
+        logging.warning(f"Not all of {folder} was uploaded, source not recorded.")
+        return
+    for source_id in source_ids:
+        record_source_upload(source_id, *files)
 
 
 def single_container_pipeline(region, hazard_type, hazard_level):
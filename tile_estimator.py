@@ -0,0 +1,224 @@
+"""
+Local dry-run of a recipe. Tiles the source geojson at the recipe's zoom levels,
+applies the recipe's simplification and estimates encoded tile sizes and counts
+per zoom before paying for a publish job.
+"""
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import mapbox_vector_tile
+import mercantile
+import numpy as np
+import shapely
+
+import geo_cache
+from mapbox_api import generate_tileset_name
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+EXTENT = 4096  # Tile coordinate extent used by MTS
+BUFFER = 64  # Tile buffer in tile units
+MAX_TILE_SIZE = 500 * 1024  # MTS tile size limit in bytes
+MAX_TILES_PER_ZOOM = 50  # Densest tiles encoded per zoom to estimate sizes
+LAYERS = {}  # Per worker: {layer: (geometries, properties, STRtree)}
+
+COMPARISONS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+def evaluate(expression, zoom):
+    """
+    Evaluates the zoom dependent parts of a recipe expression, i.e.
+    ["case", [">=", ["zoom"], 7], 1, 4]. Supports zoom, comparisons, case and step.
+    """
+    if not isinstance(expression, list):
+        return expression
+    op, *args = expression
+    if op == "zoom":
+        return zoom
+    if op in COMPARISONS:
+        return COMPARISONS[op](evaluate(args[0], zoom), evaluate(args[1], zoom))
+    if op == "case":
+        for condition, value in zip(args[:-1:2], args[1:-1:2]):
+            if evaluate(condition, zoom):
+                return evaluate(value, zoom)
+        return evaluate(args[-1], zoom)
+    if op == "step":
+        value = evaluate(args[1], zoom)
+        for stop, output in zip(args[2::2], args[3::2]):
+            if evaluate(args[0], zoom) >= stop:
+                value = evaluate(output, zoom)
+        return value
+    raise ValueError(f"Unsupported expression operator {op}")
+
+
+def load_layer(geo_file):
+    """Returns the geometries in web mercator and the properties of a geojson."""
+    gdf = geo_cache.read_file(geo_file).to_crs(epsg=3857)
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+    props = json.loads(gdf.drop(columns=gdf.geometry.name).to_json(orient="records"))
+    return np.asarray(gdf.geometry), props
+
+
+def init_worker(layers):
+    for name, (geoms, props) in layers.items():
+        LAYERS[name] = (geoms, props, shapely.STRtree(geoms))
+
+
+def active_layers(config, zoom):
+    return [
+        name
+        for name, layer in config.items()
+        if layer.get("minzoom", 0) <= zoom <= layer.get("maxzoom", 5)
+    ]
+
+
+def count_zoom(zoom, config, max_tiles=MAX_TILES_PER_ZOOM):
+    """
+    Counts the tiles of a zoom that contain features, and returns the densest
+    ones by vertex count to be encoded.
+    """
+    names = active_layers(config, zoom)
+    if not names:
+        return zoom, 0, []
+    bounds = shapely.total_bounds(np.concatenate([LAYERS[name][0] for name in names]))
+    if np.isnan(bounds).any():
+        return zoom, 0, []
+
+    west, south = mercantile.lnglat(bounds[0], bounds[1])
+    east, north = mercantile.lnglat(bounds[2], bounds[3])
+    tiles = list(mercantile.tiles(west, south, east, north, zoom))
+    boxes = shapely.box(*np.array([mercantile.xy_bounds(tile) for tile in tiles]).T)
+    weights = np.zeros(len(tiles), dtype=np.int64)
+    for name in names:
+        geoms, _, tree = LAYERS[name]
+        tile_idx, geom_idx = tree.query(boxes, predicate="intersects")
+        np.add.at(weights, tile_idx, shapely.get_num_coordinates(geoms[geom_idx]))
+
+    occupied = np.flatnonzero(weights)
+    densest = occupied[np.argsort(weights[occupied])[::-1][:max_tiles]]
+    return zoom, len(occupied), [tuple(tiles[i]) for i in densest]
+
+
+def encode_tile(tile, config):
+    """Clips, simplifies and encodes one tile. Returns (tile, raw size, gzip size)."""
+    tile = mercantile.Tile(*tile)
+    minx, miny, maxx, maxy = mercantile.xy_bounds(tile)
+    scale = np.array([EXTENT / (maxx - minx), -EXTENT / (maxy - miny)])
+    offset = np.array([minx, maxy])
+    layers = []
+    for name in active_layers(config, tile.z):
+        geoms, props, tree = LAYERS[name]
+        idx = tree.query(shapely.box(minx, miny, maxx, maxy), predicate="intersects")
+        local = shapely.transform(geoms[idx], lambda coords: (coords - offset) * scale)
+        local = shapely.clip_by_rect(
+            local, -BUFFER, -BUFFER, EXTENT + BUFFER, EXTENT + BUFFER
+        )
+        simplification = evaluate(
+            # MTS simplifies by 4 tile units when the recipe does not say
+            config[name].get("features", {}).get("simplification", 4),
+            tile.z,
+        )
+        local = shapely.simplify(local, simplification)
+        keep = ~shapely.is_empty(local)
+        features = [
+            {"geometry": geom, "properties": props[i]}
+            for geom, i in zip(local[keep], idx[keep])
+        ]
+        layers.append({"name": name, "features": features})
+
+    data = mapbox_vector_tile.encode(layers, default_options={"y_coord_down": True})
+    return tuple(tile), len(data), len(gzip.compress(data))
+
+
+def match_geo_files(recipe, geo_folder):
+    """Finds the geojson of each recipe layer using the generate_recipe naming."""
+    names = {
+        generate_tileset_name(file): os.path.join(geo_folder, file)
+        for file in os.listdir(geo_folder)
+        if file.endswith(".geojson")
+    }
+    return {layer: names[layer] for layer in recipe["layers"] if layer in names}
+
+
+def estimate_recipe(
+    recipe_path,
+    geo_folder,
+    max_tile_size=MAX_TILE_SIZE,
+    max_tiles=MAX_TILES_PER_ZOOM,
+    num_cores=5,
+):
+    """
+    Estimates tile counts and encoded sizes per zoom of a recipe.
+
+    Args:
+        recipe_path (str): Full path of the recipe, i.e. from generate_recipe.
+        geo_folder (str): Folder of the geojson files of the recipe layers.
+        max_tile_size (int): Tile size limit in bytes to flag zooms with.
+        max_tiles (int): Number of densest tiles encoded per zoom.
+
+    Returns:
+        dict: Report per zoom. Sizes are measured on the densest tiles, so the
+              total size estimate is an upper bound.
+    """
+    with open(recipe_path) as recipe_file:
+        recipe = json.load(recipe_file)
+    geo_files = match_geo_files(recipe, geo_folder)
+    config = {name: recipe["layers"][name] for name in geo_files}
+    for name in set(recipe["layers"]) - set(config):
+        logging.warning(f"No geojson found for layer {name}, skipping it.")
+    if not config:
+        raise ValueError(
+            f"No geojson in {geo_folder} matches the layers of {recipe_path}"
+        )
+
+    layers = {name: load_layer(geo_file) for name, geo_file in geo_files.items()}
+    zooms = range(
+        min(layer.get("minzoom", 0) for layer in config.values()),
+        max(layer.get("maxzoom", 5) for layer in config.values()) + 1,
+    )
+    with multiprocessing.Pool(num_cores, init_worker, (layers,)) as pool:
+        counts = pool.starmap(count_zoom, [(zoom, config, max_tiles) for zoom in zooms])
+        tasks = [(tile, config) for _, _, tiles in counts for tile in tiles]
+        sizes = pool.starmap(encode_tile, tasks, chunksize=1)
+
+    report = {}
+    for zoom, tile_count, _ in counts:
+        zoom_sizes = [size for size in sizes if size[0][2] == zoom]
+        raw = [size for _, size, _ in zoom_sizes]
+        compressed = [size for _, _, size in zoom_sizes]
+        oversized = [tile for tile, size, _ in zoom_sizes if size > max_tile_size]
+        report[zoom] = {
+            "tiles": tile_count,
+            "sampled": len(raw),
+            "max_size": max(raw, default=0),
+            "max_gzip_size": max(compressed, default=0),
+            "mean_size": int(np.mean(raw)) if raw else 0,
+            "estimated_total_size": int(np.mean(raw) * tile_count) if raw else 0,
+            "oversized": oversized,
+            "exceeds_limit": bool(oversized),
+        }
+        log = logging.warning if oversized else logging.info
+        log(
+            f"z{zoom}: {tile_count} tiles, max {report[zoom]['max_size']} bytes, "
+            f"{len(oversized)} of {len(raw)} sampled tiles over the limit"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    recipe_path = "recipes/aklan_flood_100year.json"
+    geo_folder = "data/geojson/"
+    estimate_recipe(recipe_path, geo_folder)
+    t1 = time.time()
+    logging.info(f"Elapsed time: {t1-t0:.2f}s")
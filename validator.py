@@ -0,0 +1,197 @@
+"""Validates geometry, CRS and hazard attributes before anything is uploaded"""
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import shapely
+
+import geo_cache
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+CLASS_COLUMN = "Var"  # Hazard class attribute of the NOAH hazard maps
+EXTENSIONS = (".shp", ".geojson")
+WGS84_BOUNDS = (-180.0, -90.0, 180.0, 90.0)
+
+
+def check_geodataframe(gdf, class_column=CLASS_COLUMN):
+    """
+    Runs all checks on a GeoDataFrame with vectorized geometry operations.
+
+    Returns:
+        (dict, ndarray): Count of problems per check and a boolean mask of the
+                         features that passed every check.
+    """
+    geoms = gdf.geometry.values
+    null = np.asarray(gdf.geometry.isna())
+    empty = ~null & np.asarray(shapely.is_empty(geoms))
+    invalid = ~null & ~empty & ~np.asarray(shapely.is_valid(geoms))
+
+    bounds = shapely.bounds(geoms)
+    minx, miny, maxx, maxy = WGS84_BOUNDS
+    with np.errstate(invalid="ignore"):
+        out_of_bounds = (
+            (bounds[:, 0] < minx)
+            | (bounds[:, 1] < miny)
+            | (bounds[:, 2] > maxx)
+            | (bounds[:, 3] > maxy)
+        )
+
+    # class_column=None skips the attribute checks, for layers without a class
+    has_attribute = class_column is None or class_column in gdf.columns
+    if class_column is None:
+        null_attribute = np.zeros(len(gdf), dtype=bool)
+    elif has_attribute:
+        null_attribute = np.asarray(gdf[class_column].isna())
+    else:
+        null_attribute = np.ones(len(gdf), dtype=bool)
+
+    errors = {
+        "null_geometry": int(null.sum()),
+        "empty_geometry": int(empty.sum()),
+        "invalid_geometry": int(invalid.sum()),
+        "out_of_bounds": int(out_of_bounds.sum()),
+        "missing_attribute": not has_attribute,
+        "null_attribute": int(null_attribute.sum()) if has_attribute else 0,
+    }
+    passed = ~(null | empty | invalid | out_of_bounds | null_attribute)
+    return errors, passed
+
+
+def is_wgs84(gdf):
+    return gdf.crs is not None and gdf.crs.to_epsg() == 4326
+
+
+def repair_geodataframe(gdf, class_column=CLASS_COLUMN):
+    """
+    Reprojects to EPSG:4326, fixes invalid geometries and drops features with
+    null/empty geometries or a null hazard attribute.
+    """
+    if gdf.crs is not None and not is_wgs84(gdf):
+        gdf = gdf.to_crs(epsg=4326)
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+    gdf = gdf.set_geometry(shapely.make_valid(gdf.geometry.values))
+    # make_valid can collapse polygons into empty geometries
+    gdf = gdf[~gdf.geometry.is_empty]
+    if class_column in gdf.columns:
+        gdf = gdf[gdf[class_column].notna()]
+    return gdf
+
+
+def validate_geodataframe(gdf, class_column=CLASS_COLUMN):
+    """Returns the validation report of a GeoDataFrame."""
+    errors, passed = check_geodataframe(gdf, class_column)
+    return {
+        "features": len(gdf),
+        "crs": gdf.crs.to_string() if gdf.crs is not None else None,
+        "errors": errors,
+        "valid": bool(is_wgs84(gdf) and passed.all()),
+    }
+
+
+def check_repair_folder(folder, repair_folder):
+    if repair_folder is None:
+        raise ValueError("repair_folder is required when repair is enabled")
+    if os.path.abspath(repair_folder) == os.path.abspath(folder):
+        raise ValueError(f"repair_folder must differ from the input folder {folder}")
+
+
+def validate_file(file, class_column=CLASS_COLUMN, repair=False, repair_folder=None):
+    """
+    Validates a shapefile or geojson.
+
+    Args:
+        file (str): Full path of the file.
+        class_column (str): Required hazard attribute.
+        repair (bool): Write a repaired copy when the file is invalid.
+        repair_folder (str): Folder of the repaired geojson, required for repair.
+                             Must not be the folder of the file so the source
+                             data is never overwritten.
+    """
+    if repair:
+        check_repair_folder(os.path.dirname(file), repair_folder)
+    logging.info(f"Validating {file}.")
+    report = {"file": file}
+    try:
+        gdf = geo_cache.read_file(file)
+    except Exception as e:
+        report.update({"valid": False, "read_error": str(e)})
+        return report
+
+    report.update(validate_geodataframe(gdf, class_column))
+    if repair and not report["valid"] and not report["errors"]["missing_attribute"]:
+        repaired = repair_geodataframe(gdf, class_column)
+        repair_report = validate_geodataframe(repaired, class_column)
+        if repair_report["valid"]:
+            name = f"{os.path.splitext(os.path.basename(file))[0]}.geojson"
+            os.makedirs(repair_folder, exist_ok=True)
+            output_file = os.path.join(repair_folder, name)
+            repaired.to_file(output_file, driver="GeoJSON")
+            report.update(
+                {
+                    "repaired": output_file,
+                    "features_dropped": len(gdf) - len(repaired),
+                    "valid": True,
+                }
+            )
+    return report
+
+
+def validate_folder(
+    folder,
+    class_column=CLASS_COLUMN,
+    repair=False,
+    repair_folder=None,
+    report_file=None,
+    num_cores=5,
+):
+    """
+    Validates every shapefile and geojson of a folder in parallel. With repair,
+    repaired copies of invalid files are written into repair_folder.
+
+    Returns:
+        list: Report per file. Also written as JSON to report_file if given.
+    """
+    if repair:
+        check_repair_folder(folder, repair_folder)
+    files = [
+        os.path.join(folder, file)
+        for file in sorted(os.listdir(folder))
+        if file.endswith(EXTENSIONS)
+    ]
+    with multiprocessing.Pool(num_cores) as pool:
+        reports = pool.starmap(
+            validate_file,
+            [(file, class_column, repair, repair_folder) for file in files],
+        )
+
+    invalid = [report["file"] for report in reports if not report["valid"]]
+    logging.info(f"{len(files) - len(invalid)} of {len(files)} files are valid.")
+    for file in invalid:
+        logging.error(f"Rejected {file}")
+    if report_file:
+        with open(report_file, "w") as out:
+            json.dump(reports, out, indent=4)
+    return reports
+
+
+def valid_files(reports):
+    """Returns the files to upload from the reports, using repaired copies."""
+    return [
+        report.get("repaired", report["file"]) for report in reports if report["valid"]
+    ]
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    folder = "data/geojson/FH/"
+    validate_folder(
+        folder,
+        repair=True,
+        repair_folder="data/geojson/FH_repaired/",
+        report_file="validation_report.json",
+    )
+    t1 = time.time()
+    logging.info(f"Elapsed time: {t1-t0:.2f}s")
@@ -0,0 +1,207 @@
+"""
+Long-running service that watches the shapefile and geojson folders and sends
+new or changed files through conversion, upload and publish.
+
+Usage:
+    python watcher.py data/shp data/geojson --interval 0.5
+"""
+import argparse
+import concurrent.futures as concurr
+import logging
+import multiprocessing
+import os
+import time
+
+from http_session import POOL_SIZE
+from mapbox_api import create_tileset_source, sync_tileset
+from memory_budget import MemoryBudget, MemoryModel
+from shp_converter import convert_folder_contents
+from validator import CLASS_COLUMN
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+SHP_SIDECARS = (".dbf", ".shx", ".prj")
+
+
+def file_signature(path):
+    """Returns (mtime, size) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def scan(folder, extensions, sidecars=()):
+    """
+    Returns {path: signature} of the files in folder with the extensions. The
+    signature holds (mtime, size) of the file and of each sidecar file with the
+    same name, with None for missing sidecars.
+    """
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(extensions):
+                stem = os.path.splitext(entry.path)[0]
+                files[entry.path] = (file_signature(entry.path),) + tuple(
+                    file_signature(stem + sidecar) for sidecar in sidecars
+                )
+    return files
+
+
+class FolderWatcher:
+    """
+    Polls a folder and calls handler for new or changed files. A file is only
+    handled once it and all its sidecar files exist and are unchanged between
+    two polls, so half-copied files are not picked up.
+    """
+
+    def __init__(
+        self, folder, extensions, handler, process_existing=False, sidecars=()
+    ):
+        self.folder = folder
+        self.extensions = extensions
+        self.sidecars = sidecars
+        self.handler = handler
+        self.previous = {}
+        self.handled = {} if process_existing else scan(folder, extensions, sidecars)
+
+    def poll(self):
+        current = scan(self.folder, self.extensions, self.sidecars)
+        for path, signature in current.items():
+            if None in signature:
+                continue
+            if self.previous.get(path) == signature != self.handled.get(path):
+                self.handled[path] = signature
+                self.handler(path)
+        self.previous = current
+
+
+class WatchService:
+    """
+    Keeps GDAL/geopandas imported, one multiprocessing pool for conversion and
+    one thread pool sharing the pooled HTTP session for uploads, so a dropped
+    file is processed without paying the interpreter startup again. With a
+    memory_budget, concurrent conversions share one budget and memory model.
+    """
+
+    def __init__(
+        self,
+        shp_folder,
+        geo_folder,
+        interval=0.5,
+        num_cores=5,
+        num_workers=POOL_SIZE,
+        repair=False,
+        cache=True,
+        memory_budget=None,
+        process_existing=False,
+        class_column=CLASS_COLUMN,
+        validate=True,
+    ):
+        self.geo_folder = geo_folder
+        self.interval = interval
+        self.repair = repair
+        self.cache = cache
+        self.class_column = class_column
+        self.validate = validate
+        self.memory_budget = None
+        self.memory_model = None
+        maxtasksperchild = None
+        if memory_budget is not None:
+            self.memory_budget = MemoryBudget(memory_budget)
+            self.memory_model = MemoryModel()
+            # Fresh forked workers per chunk keep the measured peaks exact
+            maxtasksperchild = 1
+        self.process_pool = multiprocessing.Pool(
+            num_cores, maxtasksperchild=maxtasksperchild
+        )
+        self.thread_pool = concurr.ThreadPoolExecutor(max_workers=num_workers)
+        self.watchers = [
+            FolderWatcher(
+                shp_folder, (".shp",), self.convert, process_existing, SHP_SIDECARS
+            ),
+            FolderWatcher(geo_folder, (".geojson",), self.upload, process_existing),
+        ]
+
+    def submit(self, func, path):
+        future = self.thread_pool.submit(func, path)
+        future.add_done_callback(lambda f: self.log_result(f, path))
+
+    @staticmethod
+    def log_result(future, path):
+        if exc := future.exception():
+            logging.error(f"Exception for {os.path.basename(path)}: {exc}")
+        else:
+            logging.info(f"Successful operation for {os.path.basename(path)}.")
+
+    def convert(self, shp_file):
+        """Converts into the geojson folder, where the upload watcher picks it up."""
+        name = os.path.splitext(os.path.basename(shp_file))[0]
+        output_file = os.path.join(self.geo_folder, f"{name}.geojson")
+        self.submit(
+            lambda path: convert_folder_contents(
+                [(path, output_file)],
+                repair=self.repair,
+                cache=self.cache,
+                pool=self.process_pool,
+                memory_budget=self.memory_budget,
+                memory_model=self.memory_model,
+                class_column=self.class_column,
+                validate=self.validate,
+            ),
+            shp_file,
+        )
+
+    def upload(self, geo_file):
+        self.submit(upload_and_publish, geo_file)
+
+    def run(self):
+        logging.info("Watching for new or changed files.")
+        try:
+            while True:
+                for watcher in self.watchers:
+                    watcher.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            logging.info("Stopping.")
+        finally:
+            self.thread_pool.shutdown(wait=True)
+            self.process_pool.close()
+            self.process_pool.join()
+
+
+def upload_and_publish(geo_file):
+    """Uploads the source, then creates or publishes the tileset only if needed."""
+    recipe_path = create_tileset_source(geo_file)
+    if recipe_path is None:
+        raise RuntimeError(f"Upload of {geo_file} failed")
+    return sync_tileset(recipe_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("shp_folder")
+    parser.add_argument("geo_folder")
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--num-cores", type=int, default=5)
+    parser.add_argument("--num-workers", type=int, default=POOL_SIZE)
+    parser.add_argument("--repair", action="store_true")
+    parser.add_argument("--no-cache", dest="cache", action="store_false")
+    parser.add_argument("--memory-budget", help="i.e. 64G")
+    parser.add_argument("--process-existing", action="store_true")
+    parser.add_argument("--class-column", default=CLASS_COLUMN)
+    parser.add_argument("--no-validate", dest="validate", action="store_false")
+    args = parser.parse_args()
+    WatchService(
+        args.shp_folder,
+        args.geo_folder,
+        interval=args.interval,
+        num_cores=args.num_cores,
+        num_workers=args.num_workers,
+        repair=args.repair,
+        cache=args.cache,
+        memory_budget=args.memory_budget,
+        process_existing=args.process_existing,
+        class_column=args.class_column,
+        validate=args.validate,
+    ).run()